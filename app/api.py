@@ -8,18 +8,15 @@ import flask
 from flask_cors import CORS
 from functools import wraps
 import redis
-import time
 
 import util.util as UTIL
 
 from routes.fred_routes import fred_routes
 from routes.zillow_routes import zillow_routes
+from routes.property_routes import property_routes
 from routes.code_search_routes import code_routes
 from routes.ms_addin_routes import ms_routes
-from services.codesearch import download_index
-
-RATE_LIMIT = 3  # Can make this many calls per second
-
+from services.codesearch import download_index, start_index_refresher
 
 redis_service = redis.Redis(
     host=UTIL.get_env('REDIS_HOST', 'localhost'),
@@ -32,10 +29,15 @@ if UTIL.get_env('DOWNLOAD_INDEX_ON_START') == 'Y':
     download_index()
     UTIL.logmessage('Search index downloaded')
 
+INDEX_REFRESH_MINUTES = int(UTIL.get_env('INDEX_REFRESH_MINUTES', 0))
+if INDEX_REFRESH_MINUTES > 0:
+    start_index_refresher(INDEX_REFRESH_MINUTES)
+
 # Set up the app
 app = flask.Flask(__name__)
 app.register_blueprint(fred_routes)
 app.register_blueprint(zillow_routes)
+app.register_blueprint(property_routes)
 app.register_blueprint(code_routes)
 app.register_blueprint(ms_routes)
 
@@ -54,6 +56,7 @@ cors = CORS(app, resources={r"/*": {"origins": config['ORIGINS']}}, supports_cre
 # Enable CORS on the blueprints
 CORS(fred_routes)
 CORS(zillow_routes)
+CORS(property_routes)
 CORS(code_routes)
 CORS(ms_routes)
 
@@ -116,13 +119,7 @@ def verify_rate_limit() -> bool:
         return authentication_failed()
 
     token = flask.request.authorization.username
-    timestamp = int(time.time())
-    key = f'rate_{token}_{timestamp}'
-    pipe = redis_service.pipeline()
-    pipe.incr(key)
-    pipe.expire(key, 1)
-    result = pipe.execute()
-    if result[0] >= RATE_LIMIT:
+    if UTIL.rate_limited(redis_service, token):
         return UTIL.failure_message("Rate Limited", "ERR_RATE_LIMIT")
     return None
 
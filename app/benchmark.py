@@ -0,0 +1,607 @@
+"""
+benchmark.py - Measure code search performance on a synthetic corpus.
+
+Generates codes shaped like the real ones (titles, chapters, numbered
+sections, and text whose words follow a Zipf distribution), builds an index
+from them with the indexer, and times services.codesearch.search() over a
+mix of plain term, phrase, fuzzy, and code-filtered queries. Latency
+percentiles, throughput, memory, and index size are written as JSON, so
+runs before and after a change can be compared. Before timing, a sample of
+the queries is run through checks that different ways of running the same
+search agree; any failures are listed under "checks" in the report.
+
+Usage:
+    python benchmark.py --sections 10000
+    python benchmark.py --sections 1000000 --queries 5000 --threads 4 --output after.json
+    python benchmark.py --work-dir /tmp/bench --reuse    Search the corpus from an earlier run
+
+Progress messages go to stderr; the results go to --output or stdout.
+INDEX_SHARDED and the search settings in the environment apply as usual.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from indexer import build
+from util.doc_store import DATA_FILE, INDEX_FILE
+import util.functions as FN
+import util.util as UTIL
+
+# Codes to generate, in order, with their full names.
+CODE_NAMES = [
+    ('fa', "Texas Family Code"),
+    ('pe', "Texas Penal Code"),
+    ('es', "Texas Estates Code"),
+    ('cp', "Texas Civil Practice and Remedies Code"),
+    ('bc', "Texas Business and Commerce Code"),
+    ('gv', "Texas Government Code"),
+    ('hs', "Texas Health and Safety Code"),
+    ('pr', "Texas Property Code"),
+    ('tx', "Texas Tax Code"),
+    ('tn', "Texas Transportation Code"),
+    ('ed', "Texas Education Code"),
+    ('lg', "Texas Local Government Code"),
+]
+
+# Common statutory words. The rest of the vocabulary is made up.
+LEGAL_WORDS = """
+    court party child parent order person shall may section under subsection
+    chapter provided attorney petition suit hearing notice judgment custody
+    conservator support obligor obligee possession access property estate
+    executor guardian offense defendant conviction felony misdemeanor degree
+    punishment fine jail contract agreement damages liability claim plaintiff
+    county district municipal state agency commission board filing record
+    evidence testimony witness motion appeal bond security interest title
+    deed lease tenant landlord mortgage lien trust trustee beneficiary will
+    heir spouse marriage divorce dissolution adoption termination paternity
+    protective violence family household member temporary final modification
+    enforcement contempt arrears payment income employer withholding medical
+    insurance residence domicile jurisdiction venue transfer registration
+""".split()
+
+SYLLABLES = [
+    'ab', 'ac', 'al', 'an', 'ar', 'as', 'at', 'ben', 'car', 'cer', 'con', 'cor',
+    'de', 'di', 'dis', 'en', 'er', 'es', 'ex', 'fer', 'gra', 'im', 'in', 'ing',
+    'is', 'it', 'jur', 'lat', 'lec', 'ment', 'mis', 'mon', 'na', 'ne', 'no',
+    'or', 'pen', 'per', 'pre', 'pro', 're', 'ri', 'sen', 'sion', 'ta', 'ten',
+    'ter', 'tion', 'to', 'tra', 'un', 'ver', 'vi', 'vo'
+]
+
+# Sections in each generated chapter, and chapters in each title.
+SECTIONS_PER_CHAPTER = (10, 40)
+CHAPTERS_PER_TITLE = 12
+
+# Words in a section's text.
+TEXT_WORDS = (40, 400)
+
+# Sections whose text is kept for drawing phrase and fuzzy queries.
+SAMPLE_SIZE = 2000
+
+# Queries run through check_searches() before timing.
+CHECK_QUERIES = 20
+
+# A code abbreviation that is never generated.
+MISSING_CODE = 'zz'
+
+QUERY_KINDS = ('term', 'phrase', 'fuzzy', 'filtered')
+DEFAULT_MIX = 'term=40,phrase=20,fuzzy=20,filtered=20'
+
+
+class Corpus(object):
+    """
+    Synthetic codes written to a code directory in the indexer's format.
+    """
+
+    def __init__(self, code_path: str, sections: int, codes: int, vocabulary: int, seed: int):
+        """
+        Instance initializer.
+
+        Args:
+            code_path (str): Directory to write the code files to.
+            sections (int): Total sections to generate.
+            codes (int): Number of codes to spread the sections over.
+            vocabulary (int): Distinct words used in section text.
+            seed (int): Random seed, so runs with the same arguments match.
+        """
+        self.code_path = code_path
+        self.sections = sections
+        self.codes = CODE_NAMES[:max(1, min(codes, len(CODE_NAMES)))]
+        self.random = random.Random(seed)
+        self.words = make_vocabulary(self.random, vocabulary)
+        self.weights = zipf_weights(len(self.words))
+        self.samples = []
+        self.bytes = 0
+
+    def generate(self):
+        """
+        Write every code's configuration and section files.
+        """
+        os.makedirs(self.code_path, exist_ok=True)
+        per_code, extra = divmod(self.sections, len(self.codes))
+        seen = 0
+        for position, (code_name, full_name) in enumerate(self.codes):
+            with open(os.path.join(self.code_path, f'{code_name}.json'), 'w') as fp:
+                json.dump({'code_name': code_name, 'code_full_name': full_name}, fp)
+            count = per_code + (1 if position < extra else 0)
+            with open(os.path.join(self.code_path, f'{code_name}.jsonl'), 'w') as fp:
+                for section in self.code_sections(code_name, count):
+                    line = json.dumps(section) + '\n'
+                    fp.write(line)
+                    self.bytes += len(line)
+                    seen += 1
+                    self.sample(seen, code_name, section['text'])
+
+    def read(self):
+        """
+        Sample the sections already written to the code directory by an
+        earlier run, instead of generating them again.
+        """
+        self.codes = [code for code in self.codes if os.path.exists(os.path.join(self.code_path, f'{code[0]}.jsonl'))]
+        seen = 0
+        for code_name, full_name in self.codes:
+            with open(os.path.join(self.code_path, f'{code_name}.jsonl'), 'r') as fp:
+                for line in fp:
+                    self.bytes += len(line)
+                    seen += 1
+                    self.sample(seen, code_name, json.loads(line)['text'])
+        self.sections = seen
+
+    def code_sections(self, code_name: str, count: int):
+        """
+        Generate the sections of one code.
+
+        Args:
+            code_name (str): Code abbreviation.
+            count (int): Number of sections.
+        Yields:
+            (dict): Fields for one section.
+        """
+        chapter = 0
+        made = 0
+        while made < count:
+            chapter += 1
+            title = (chapter - 1) // CHAPTERS_PER_TITLE + 1
+            chapter_name = ' '.join(self.draw(3)).upper()
+            for number in range(1, self.random.randint(*SECTIONS_PER_CHAPTER) + 1):
+                if made == count:
+                    break
+                text = ' '.join(self.draw(self.random.randint(*TEXT_WORDS)))
+                made += 1
+                yield {
+                    'code': code_name.upper(),
+                    'title': f'{title}. TITLE {title}',
+                    'subtitle': 'A. GENERAL PROVISIONS',
+                    'chapter': f'{chapter}. {chapter_name}',
+                    'subchapter': f'{chr(ord("A") + (number - 1) // 10)}. SUBCHAPTER',
+                    'section_prefix': 'Sec.',
+                    'section_number': f'{chapter}.{number:03d}',
+                    'section_name': ' '.join(self.draw(self.random.randint(2, 6))).upper(),
+                    'text': text,
+                    'source_text': text,
+                    'filename': f'{code_name.upper()}.{chapter}.htm',
+                }
+
+    def draw(self, count: int) -> list:
+        """
+        Draw words from the vocabulary, common words more often.
+        """
+        return self.random.choices(self.words, cum_weights=self.weights, k=count)
+
+    def sample(self, seen: int, code_name: str, text: str):
+        """
+        Keep a uniform sample of section texts to draw queries from.
+        """
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append((code_name, text.split()))
+            return
+        slot = self.random.randrange(seen)
+        if slot < SAMPLE_SIZE:
+            self.samples[slot] = (code_name, text.split())
+
+
+def make_vocabulary(rng: random.Random, size: int) -> list:
+    """
+    Build a vocabulary of the legal words followed by made-up words.
+
+    Args:
+        rng (random.Random): Random number generator.
+        size (int): Words wanted.
+    Returns:
+        (list): Distinct words, most common first.
+    """
+    words = list(dict.fromkeys(LEGAL_WORDS))
+    known = set(words)
+    while len(words) < size:
+        word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if word not in known:
+            known.add(word)
+            words.append(word)
+    return words[:size]
+
+
+def zipf_weights(count: int) -> list:
+    """
+    Cumulative Zipf weights for random.choices().
+    """
+    weights = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1.0 / rank
+        weights.append(total)
+    return weights
+
+
+def make_queries(corpus: Corpus, count: int, mix: dict, rng: random.Random) -> list:
+    """
+    Build the queries to run, drawn from the sampled sections so most of
+    them find something.
+
+    Args:
+        corpus (Corpus): Generated corpus.
+        count (int): Number of queries.
+        mix (dict): Relative weight of each query kind.
+        rng (random.Random): Random number generator.
+    Returns:
+        (list): (kind, query text, code list) tuples.
+    """
+    kinds = [kind for kind in QUERY_KINDS if mix.get(kind)]
+    weights = [mix[kind] for kind in kinds]
+    code_names = [code_name for code_name, full_name in corpus.codes]
+    queries = []
+    for kind in rng.choices(kinds, weights=weights, k=count):
+        code_name, words = rng.choice(corpus.samples)
+        if kind == 'phrase':
+            length = rng.randint(2, 3)
+            start = rng.randrange(len(words) - length + 1)
+            queries.append((kind, '"' + ' '.join(words[start:start + length]) + '"', '*'))
+        elif kind == 'fuzzy':
+            queries.append((kind, misspell(rng, words) + '~', '*'))
+        elif kind == 'filtered':
+            codes = rng.sample(code_names, min(len(code_names), rng.randint(1, 2)))
+            if code_name not in codes:
+                codes[0] = code_name
+            queries.append((kind, ' '.join(rng.sample(words, 2)), ' '.join(codes)))
+        else:
+            queries.append((kind, ' '.join(rng.sample(words, rng.randint(1, 3))), '*'))
+    return queries
+
+
+def misspell(rng: random.Random, words: list) -> str:
+    """
+    Pick a word and change one of its letters after the first.
+    """
+    candidates = [word for word in words if len(word) >= 5] or words
+    word = rng.choice(candidates)
+    if len(word) < 2:
+        return word
+    position = rng.randrange(1, len(word))
+    letter = rng.choice([c for c in 'aeioulnrst' if c != word[position]])
+    return word[:position] + letter + word[position + 1:]
+
+
+def parse_mix(text: str) -> dict:
+    """
+    Parse a query mix such as "term=40,phrase=20,fuzzy=20,filtered=20".
+
+    Args:
+        text (str): Comma-separated kind=weight pairs.
+    Returns:
+        (dict): Weight for each query kind.
+    Raises:
+        ValueError: If a kind is unknown or no kind has a weight.
+    """
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.strip().partition('=')
+        if kind not in QUERY_KINDS:
+            raise ValueError(f"Unknown query kind: {kind}")
+        mix[kind] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("The query mix needs at least one query kind")
+    return mix
+
+
+def latency_summary(seconds: list) -> dict:
+    """
+    Summarize query times.
+
+    Args:
+        seconds (list): Time taken by each query, in seconds.
+    Returns:
+        (dict): Count, mean, percentiles, and maximum, in milliseconds.
+    """
+    if not seconds:
+        return {'count': 0}
+    ordered = sorted(seconds)
+    summary = {'count': len(ordered), 'mean': sum(ordered) / len(ordered)}
+    for percentile in (50, 90, 95, 99):
+        # Nearest rank
+        rank = max(1, -(-percentile * len(ordered) // 100))
+        summary[f'p{percentile}'] = ordered[rank - 1]
+    summary['max'] = ordered[-1]
+    return {key: value if key == 'count' else round(value * 1000, 3) for key, value in summary.items()}
+
+
+def directory_size(path: str) -> dict:
+    """
+    Measure an index directory.
+
+    Args:
+        path (str): Index directory.
+    Returns:
+        (dict): Bytes in the document store, the Whoosh index, and in total.
+    """
+    store = 0
+    total = 0
+    for folder, _, files in os.walk(path):
+        for file_name in files:
+            size = os.path.getsize(os.path.join(folder, file_name))
+            total += size
+            if file_name in (DATA_FILE, INDEX_FILE):
+                store += size
+    return {'total_bytes': total, 'docstore_bytes': store, 'whoosh_bytes': total - store}
+
+
+def max_rss() -> int:
+    """
+    Peak resident set size of this process in bytes, or None where the
+    resource module is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def check_searches(args, corpus: Corpus, queries: list) -> dict:
+    """
+    Run some of the queries in ways that must agree with each other, along
+    with a query for the most common words, which matches enough sections
+    for Whoosh to start skipping low-scoring ones.
+
+    Args:
+        args (argparse): Command line arguments.
+        corpus (Corpus): Generated corpus.
+        queries (list): (kind, query text, code list) tuples from make_queries().
+    Returns:
+        (dict): Number of queries checked and a description of each failure.
+    """
+    import services.code_index as CI
+    import services.codesearch as CODE
+
+    CI.CODE_INDEX.index_path = args.index_path
+    failures = []
+    checked = [('term', ' '.join(corpus.words[:2]), '*')] + queries[:CHECK_QUERIES]
+    for kind, query_text, code_list in checked:
+        CODE.RESULT_CACHE.clear()
+        missing = CODE.search(query_text, MISSING_CODE, fields=['code'])
+        if missing['total']:
+            failures.append(f"{query_text!r} in {MISSING_CODE}: {missing['total']} hits in a code with no documents")
+
+        # Counting hits by code must not change how many there are.
+        CODE.RESULT_CACHE.clear()
+        plain = CODE.search(query_text, code_list, page=1, pagelen=10, fields=['code'])
+        faceted = CODE.search(query_text, code_list, page=1, pagelen=10, fields=['code'], facets=['code'])
+        if plain.get('truncated') or faceted.get('truncated'):
+            continue
+        if faceted['total'] != plain['total']:
+            failures.append(f"{query_text!r}: {faceted['total']} hits with facets, {plain['total']} without")
+        counted = sum(faceted['facets']['code'].values())
+        if counted != faceted['total']:
+            failures.append(f"{query_text!r}: code facets count {counted} of {faceted['total']} hits")
+    return {'queries': len(checked), 'failures': failures}
+
+
+def run_searches(args, queries: list) -> dict:
+    """
+    Time the queries against the index in args.index_path.
+
+    Args:
+        args (argparse): Command line arguments.
+        queries (list): (kind, query text, code list) tuples from make_queries().
+    Returns:
+        (dict): Search results for the report.
+    """
+    # Imported here so CODE_PATH is set before the catalog reads it.
+    import services.code_index as CI
+    import services.codesearch as CODE
+    import services.search_limits as LIMITS
+
+    CI.CODE_INDEX.index_path = args.index_path
+    fields = [field.strip() for field in args.fields.split(',')] if args.fields else None
+
+    def one_search(query):
+        kind, query_text, code_list = query
+        if not args.cache:
+            CODE.RESULT_CACHE.clear()
+        started = time.perf_counter()
+        try:
+            result = CODE.search(query_text, code_list, fields=fields, limit=args.limit)
+        except Exception as e:
+            UTIL.logmessage(f"Query failed: {query_text}: {e}")
+            return (kind, time.perf_counter() - started, None)
+        return (kind, time.perf_counter() - started, result)
+
+    started = time.perf_counter()
+    one_search(queries[0])
+    open_seconds = time.perf_counter() - started
+    for query in queries[1:args.warmup + 1]:
+        one_search(query)
+
+    rss_before = max_rss()
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    if args.threads > 1:
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            timings = list(executor.map(one_search, queries))
+    else:
+        timings = [one_search(query) for query in queries]
+    elapsed = time.perf_counter() - started
+    traced_peak = None
+    if args.tracemalloc:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    by_kind = {}
+    hits = 0
+    errors = 0
+    truncated = 0
+    for kind, seconds, result in timings:
+        by_kind.setdefault(kind, []).append(seconds)
+        if result is None:
+            errors += 1
+            continue
+        hits += result.get('total', result.get('count', 0))
+        truncated += 1 if result.get('truncated') else 0
+
+    return {
+        'search': {
+            'queries': len(queries),
+            'threads': args.threads,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_qps': round(len(queries) / elapsed, 1) if elapsed else None,
+            'first_search_ms': round(open_seconds * 1000, 3),
+            'mean_hits': round(hits / max(1, len(queries) - errors), 1),
+            'errors': errors,
+            'truncated': truncated,
+            'latency_ms': latency_summary([seconds for kind, seconds, result in timings]),
+            'latency_ms_by_kind': {kind: latency_summary(by_kind[kind]) for kind in QUERY_KINDS if kind in by_kind},
+        },
+        'memory': {
+            'max_rss_bytes_before_search': rss_before,
+            'max_rss_bytes': max_rss(),
+            'tracemalloc_peak_bytes': traced_peak,
+        },
+        'settings': {
+            'sharded': FN.SHARDED,
+            'cache': args.cache,
+            'fields': fields,
+            'limit': args.limit,
+            'search_time_limit': LIMITS.SEARCH_TIME_LIMIT,
+            'fuzzy_max_terms': LIMITS.FUZZY_MAX_TERMS,
+        },
+    }
+
+
+def benchmark(args) -> dict:
+    """
+    Generate the corpus, build the index, and run the searches.
+
+    Args:
+        args (argparse): Command line arguments.
+    Returns:
+        (dict): Benchmark report.
+    """
+    code_path = os.path.join(args.work_dir, 'codes')
+    args.index_path = os.path.join(args.work_dir, 'index')
+    os.environ['CODE_PATH'] = code_path
+
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'work_dir': args.work_dir,
+    }
+
+    corpus = Corpus(code_path, args.sections, args.codes, args.vocabulary, args.seed)
+    reuse = args.reuse and os.path.isdir(args.index_path)
+    started = time.perf_counter()
+    if reuse:
+        UTIL.logmessage(f"Sampling the sections in {code_path}")
+        corpus.read()
+    else:
+        UTIL.logmessage(f"Generating {args.sections} sections in {len(corpus.codes)} codes")
+        corpus.generate()
+    report['corpus'] = {
+        'sections': corpus.sections,
+        'codes': len(corpus.codes),
+        'vocabulary': len(corpus.words),
+        'seed': args.seed,
+        'bytes': corpus.bytes,
+        'seconds': round(time.perf_counter() - started, 3),
+        'reused': reuse,
+    }
+
+    if not reuse:
+        build_args = argparse.Namespace(
+            all=True, code=None, index_path=args.index_path, code_path=code_path,
+            procs=args.procs, limitmb=args.limitmb
+        )
+        started = time.perf_counter()
+        documents = build(build_args)
+        build_seconds = time.perf_counter() - started
+        report['build'] = {
+            'documents': documents,
+            'seconds': round(build_seconds, 3),
+            'documents_per_second': round(documents / build_seconds, 1) if build_seconds else None,
+            'procs': args.procs,
+        }
+    report['index'] = directory_size(args.index_path)
+
+    queries = make_queries(corpus, args.queries, parse_mix(args.mix), random.Random(args.seed + 1))
+    report['query_mix'] = args.mix
+    report['checks'] = check_searches(args, corpus, queries)
+    for failure in report['checks']['failures']:
+        UTIL.logmessage(f"Check failed: {failure}")
+    UTIL.logmessage(f"Running {len(queries)} queries on {args.threads} thread(s)")
+    report.update(run_searches(args, queries))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark code search on a synthetic corpus.")
+    parser.add_argument('--sections', type=int, default=10000, help="Sections to generate (default: 10000)")
+    parser.add_argument('--codes', type=int, default=8, help=f"Codes to spread them over (at most {len(CODE_NAMES)})")
+    parser.add_argument('--vocabulary', type=int, default=20000, help="Distinct words in section text")
+    parser.add_argument('--seed', type=int, default=2021, help="Random seed")
+    parser.add_argument('--work-dir', help="Directory for the corpus and index (default: a new temporary directory)")
+    parser.add_argument('--reuse', action='store_true', help="Search the index already in --work-dir instead of rebuilding it")
+    parser.add_argument('--procs', type=int, default=os.cpu_count() or 1, help="Indexing processes")
+    parser.add_argument('--limitmb', type=int, default=256, help="Indexing memory limit per process, in MB")
+    parser.add_argument('--queries', type=int, default=1000, help="Queries to time")
+    parser.add_argument('--warmup', type=int, default=20, help="Untimed queries run first")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Relative weight of each query kind (default: {DEFAULT_MIX})")
+    parser.add_argument('--threads', type=int, default=1, help="Threads searching at once")
+    parser.add_argument('--limit', type=int, help="Hits per search (default: SEARCH_LIMIT)")
+    parser.add_argument('--fields', help="Fields to return, comma-separated (default: every field, with highlights)")
+    parser.add_argument('--cache', action='store_true', help="Leave the result cache on")
+    parser.add_argument('--tracemalloc', action='store_true', help="Trace Python allocations while searching (slower)")
+    parser.add_argument('--output', help="File to write the JSON report to (default: stdout)")
+    args = parser.parse_args()
+
+    if args.work_dir is None:
+        args.work_dir = tempfile.mkdtemp(prefix='codesearch-bench-')
+    os.makedirs(args.work_dir, exist_ok=True)
+    args.queries = max(1, args.queries)
+
+    # Keep stdout for the report.
+    with redirect_stdout(sys.stderr):
+        report = benchmark(args)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
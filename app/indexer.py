@@ -0,0 +1,240 @@
+"""
+indexer.py - Build the code search index from per-code section files.
+
+Each code has a configuration file, CODE_PATH/<code>.json, and a section file,
+CODE_PATH/<code>.jsonl, holding one JSON object per section whose keys are
+the field names in util.functions.schema().
+
+Usage:
+    python indexer.py --all                 Rebuild the whole index
+    python indexer.py --code fa --code pe   Re-index just these codes
+
+Unless --index-path is given, a full rebuild is written to a new version of
+the index, and re-indexed codes are written to a copy of the version being
+served. The new version is published when it is complete, so the API
+switches to it without a restart. The version being served is never
+written to, because its searchers and document store are already open. With INDEX_SHARDED=Y, each code gets its own index.
+
+The text and source text of each section are appended to the document
+store in the index directory (see util.doc_store) instead of being stored
+in the index.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import argparse
+from datetime import datetime
+import glob
+import json
+import os
+import shutil
+import time
+
+from whoosh.index import create_in, exists_in, open_dir
+
+from util.doc_store import DocStoreWriter
+import util.functions as FN
+import util.util as UTIL
+
+
+def section_file(code_name: str, code_path: str) -> str:
+    """
+    Get the name of the section file for a code.
+
+    Args:
+        code_name (str): Two-letter code abbreviation.
+        code_path (str): Directory holding code configs and section files.
+    Returns:
+        (str): Path to the code's section file.
+    """
+    return f'{code_path}/{code_name.lower()}.jsonl'
+
+
+def all_codes(code_path: str) -> list:
+    """
+    Find every code that has both a configuration and a section file.
+
+    Args:
+        code_path (str): Directory holding code configs and section files.
+    Returns:
+        (list): Two-letter code abbreviations.
+    """
+    codes = []
+    for config_file in sorted(glob.glob(f'{code_path}/??.json')):
+        code_name = os.path.basename(config_file)[:2].lower()
+        if os.path.exists(section_file(code_name, code_path)):
+            codes.append(code_name)
+    return codes
+
+
+def read_sections(code_name: str, code_path: str):
+    """
+    Read the sections of a code, ready to add to the index.
+
+    Args:
+        code_name (str): Two-letter code abbreviation.
+        code_path (str): Directory holding code configs and section files.
+    Yields:
+        (dict): Fields for one document.
+    """
+    with open(f'{code_path}/{code_name.lower()}.json', 'r') as fp:
+        config = json.load(fp)
+    field_names = set(FN.schema().names())
+
+    with open(section_file(code_name, code_path), 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            section = json.loads(line)
+            doc = {name: value for name, value in section.items() if name in field_names and value is not None}
+            doc.setdefault('code', code_name.upper())
+            doc.setdefault('code_name', config.get('code_full_name', code_name.upper()))
+            effective_date = doc.get('future_effective_date')
+            if isinstance(effective_date, str):
+                try:
+                    doc['future_effective_date'] = datetime.fromisoformat(effective_date)
+                except ValueError:
+                    del doc['future_effective_date']
+            yield doc
+
+
+def build(args) -> int:
+    """
+    Add the requested codes to the index, replacing any documents already
+    indexed for them. With --all, the index is rebuilt from scratch.
+
+    When the index is sharded (INDEX_SHARDED=Y), each code is written to its
+    own index, so re-indexing a code leaves the other codes untouched.
+
+    Args:
+        args (argparse): Command line arguments.
+    Returns:
+        (int): Number of documents indexed.
+    """
+    index_path = args.index_path
+    code_path = args.code_path
+    version = None
+
+    if index_path is not None and os.path.realpath(index_path) == os.path.realpath(FN.current_index_path()):
+        UTIL.logmessage(f"{index_path} is the index being served. Omit --index-path to build a new version.")
+        return 0
+
+    if args.all:
+        codes = all_codes(code_path)
+        if index_path is None:
+            version, index_path = FN.new_index_version()
+        elif not os.path.exists(index_path):
+            os.makedirs(index_path)
+    else:
+        codes = [code.lower() for code in args.code]
+        source_path = index_path or FN.current_index_path()
+        if not FN.SHARDED and not exists_in(source_path, FN.MAIN_INDEX):
+            UTIL.logmessage(f"No index in {source_path}. Use --all to create one.")
+            return 0
+        if index_path is None:
+            version, index_path = FN.copy_index_version(source_path)
+
+    started = time.time()
+    total = 0
+    try:
+        with DocStoreWriter(index_path, truncate=args.all) as store:
+            if FN.SHARDED:
+                for code_name in codes:
+                    total += index_codes(args, index_path, FN.index_name(code_name), [code_name], store)
+            else:
+                total = index_codes(args, index_path, FN.MAIN_INDEX, codes, store)
+    except Exception:
+        if version is not None:
+            shutil.rmtree(index_path, ignore_errors=True)
+        raise
+
+    if version is not None:
+        FN.publish_index_version(version)
+        UTIL.logmessage(f"Published index version {version}")
+
+    elapsed = time.time() - started
+    rate = total / elapsed if elapsed else 0
+    UTIL.logmessage(f"Indexed {total} documents from {len(codes)} codes in {elapsed:.1f}s ({rate:.0f} documents/sec)")
+    return total
+
+
+def index_codes(args, index_path: str, name: str, codes: list, store: DocStoreWriter) -> int:
+    """
+    Write the sections of some codes to one index in a single commit.
+
+    Args:
+        args (argparse): Command line arguments.
+        index_path (str): Index directory.
+        name (str): Index name.
+        codes (list): Two-letter code abbreviations.
+        store (DocStoreWriter): Document store for the section bodies.
+    Returns:
+        (int): Number of documents indexed.
+    """
+    if args.all or not exists_in(index_path, name):
+        index = create_in(index_path, FN.schema(), name)
+    else:
+        index = open_dir(index_path, name)
+
+    writer = index.writer(procs=args.procs, limitmb=args.limitmb, multisegment=args.procs > 1)
+    total = 0
+    try:
+        for code_name in codes:
+            code_started = time.time()
+            if not args.all:
+                deleted = delete_code(writer, code_name)
+                UTIL.logmessage(f"{code_name.upper()}: removed {deleted} documents")
+            count = 0
+            for doc in read_sections(code_name, args.code_path):
+                doc['body_id'] = store.add(doc.get('text'), doc.get('source_text'))
+                writer.add_document(**doc)
+                count += 1
+            elapsed = time.time() - code_started
+            UTIL.logmessage(f"{code_name.upper()}: queued {count} documents in {elapsed:.1f}s")
+            total += count
+        # Bodies must be on disk before the documents that refer to them.
+        store.flush()
+        UTIL.logmessage(f"Committing index '{name}'")
+        writer.commit()
+    except Exception:
+        writer.cancel()
+        raise
+    return total
+
+
+def delete_code(writer, code_name: str) -> int:
+    """
+    Delete every document of a code. Documents are matched by the code as
+    stored, because the analyzed code field drops codes that are stop
+    words, such as IN (the Insurance Code).
+
+    Args:
+        writer (whoosh.writing.IndexWriter): Writer for the index.
+        code_name (str): Two-letter code abbreviation.
+    Returns:
+        (int): Number of documents deleted.
+    """
+    deleted = 0
+    with writer.reader() as reader:
+        for docnum, fields in reader.iter_docs():
+            if fields.get('code', '').lower() == code_name.lower():
+                writer.delete_document(docnum)
+                deleted += 1
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the code search index.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--all', action='store_true', help="Rebuild the index from every code in CODE_PATH")
+    group.add_argument('--code', action='append', help="Re-index one code (may be repeated)")
+    parser.add_argument('--index-path', help="Index directory (default: a new version in INDEX_PATH)")
+    parser.add_argument('--code-path', default=UTIL.get_env('CODE_PATH', 'codes'), help="Code directory (default: CODE_PATH)")
+    parser.add_argument('--procs', type=int, default=os.cpu_count() or 1, help="Indexing processes")
+    parser.add_argument('--limitmb', type=int, default=256, help="Memory limit per process, in MB")
+    args = parser.parse_args()
+    build(args)
+
+
+if __name__ == '__main__':
+    main()
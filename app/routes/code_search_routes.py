@@ -3,21 +3,21 @@ code_search_routes.py - Flask Routes for handling Code Search requests.
 
 Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 """
-import redis
-import json
 import util.util as UTIL
 import services.codesearch as CODE
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
 import urllib.parse
 
 code_routes = Blueprint('code_routes', __name__, template_folder='templates')
 
+# Most queries accepted in one batch request
+BATCH_MAX_QUERIES = int(UTIL.get_env('BATCH_MAX_QUERIES', 100))
 
-redis_service = redis.Redis(
-    host=UTIL.get_env('REDIS_HOST', 'localhost'),
-    port=int(UTIL.get_env('REDIS_PORT', 6379)),
-    db=0
-)
+# Counters for the batch search budget (UTIL.BATCH_RATE_LIMIT)
+RATE_REDIS = UTIL.redis_connection()
+
+# Access keys allowed to use the admin routes
+ADMIN_USERS = [u.strip() for u in UTIL.get_env('ADMIN_USERS', '').split(',') if u.strip()]
 
 
 @code_routes.route('/codesearch/search/<string:query>/<string:codelist>/', methods=['GET'])
@@ -26,28 +26,161 @@ def search_codified_laws(query, codelist):
     u_query = urllib.parse.unquote(u_query)
     u_codelist = urllib.parse.unquote_plus(codelist)
     u_codelist = urllib.parse.unquote(u_codelist)
-    matches = CODE.search(u_query, u_codelist)
+    page = request.args.get('page', type=int)
+    pagelen = request.args.get('pagelen', type=int)
+    limit = request.args.get('limit', type=int)
+    fields = split_list(request.args.get('fields'))
+    facets = split_list(request.args.get('facets'))
+    if wants_stream():
+        return stream_search(u_query, u_codelist, page, pagelen, fields, facets)
+    try:
+        matches = CODE.search(u_query, u_codelist, page=page, pagelen=pagelen, fields=fields, limit=limit, facets=facets)
+    except ValueError as e:
+        return jsonify(UTIL.failure_message(str(e), 'ERR_BAD_FIELDS'))
     return jsonify(matches)
 
 
+def split_list(value: str) -> list:
+    """
+    Split a comma-separated query parameter, e.g. fields=code,section_number.
+    """
+    if not value:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def wants_stream() -> bool:
+    """
+    See if the caller asked for newline-delimited JSON, either with the
+    Accept header or with stream=1.
+    """
+    if request.args.get('stream', '') in ['1', 'Y', 'y', 'true']:
+        return True
+    return request.accept_mimetypes.best == 'application/x-ndjson'
+
+
+def stream_search(query, codelist, page, pagelen, fields, facets=None):
+    """
+    Stream search results as newline-delimited JSON: one line per document
+    followed by a summary line with the count and query.
+    """
+    try:
+        documents = CODE.iter_search(query, codelist, page=page, pagelen=pagelen, fields=fields, facets=facets)
+        first = next(documents)
+    except ValueError as e:
+        return jsonify(UTIL.failure_message(str(e), 'ERR_BAD_FIELDS'))
+
+    def generate():
+        yield current_app.json.dumps(first) + '\n'
+        for doc in documents:
+            yield current_app.json.dumps(doc) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@code_routes.route('/codesearch/batch/', methods=['POST'])
+def batch_search():
+    """
+    Run a list of searches in one request. The body is a JSON list of
+    {query, codes, limit, fields} objects, or an object with that list in
+    'queries'. Besides counting once against the rate limit, as every
+    request does, each query counts once against the batch budget, and a
+    batch the budget cannot cover is rejected without running any of it.
+    """
+    body = request.get_json(silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else body
+    if not isinstance(queries, list):
+        return jsonify(UTIL.failure_message("Expected a JSON list of queries", 'ERR_BAD_QUERY'))
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify(UTIL.failure_message(f"At most {BATCH_MAX_QUERIES} queries per batch", 'ERR_BATCH_TOO_LARGE'))
+    if request.authorization and UTIL.batch_rate_limited(RATE_REDIS, request.authorization.username, len(queries)):
+        return jsonify(UTIL.failure_message(
+            f"Rate Limited: at most {UTIL.BATCH_RATE_LIMIT} batch queries per second",
+            'ERR_RATE_LIMIT'
+        ))
+    message = UTIL.success_message()
+    message['data'] = CODE.batch_search(queries)
+    return jsonify(message)
+
+
+@code_routes.route('/codesearch/cite/<string:citation>/', methods=['GET'])
+def cite_section(citation):
+    """
+    Get the sections a citation refers to, e.g. "Fam. Code 153.009" or
+    "153.001-153.015". Citations that do not name a code are looked up in
+    the codes listed in the optional codes parameter, or in every code.
+    """
+    u_citation = urllib.parse.unquote_plus(citation)
+    u_citation = urllib.parse.unquote(u_citation)
+    page = request.args.get('page', type=int)
+    pagelen = request.args.get('pagelen', type=int)
+    fields = split_list(request.args.get('fields'))
+    try:
+        matches = CODE.cite(u_citation, request.args.get('codes', '*'), page=page, pagelen=pagelen, fields=fields)
+    except ValueError as e:
+        return jsonify(UTIL.failure_message(str(e), 'ERR_BAD_FIELDS'))
+    if matches is None:
+        return jsonify(UTIL.failure_message(f"No sections found for {u_citation}", 'ERR_NOT_FOUND'))
+    return jsonify(matches)
+
+
+@code_routes.route('/codesearch/suggest/<string:prefix>/', methods=['GET'])
+def suggest(prefix):
+    """
+    Suggest words and section names for a query as it is typed. Suggestions
+    come from memory, so this is cheap enough to call on every keystroke.
+    """
+    u_prefix = urllib.parse.unquote_plus(prefix)
+    u_prefix = urllib.parse.unquote(u_prefix)
+    codelist = request.args.get('codes', '*')
+    limit = request.args.get('limit', type=int)
+    return jsonify(CODE.suggest(u_prefix, codelist, limit))
+
+
+@code_routes.route('/codesearch/doc/<string:code>/<string:section_number>/', methods=['GET'])
+def get_section(code, section_number):
+    """
+    Get the full text of one section of a code.
+    """
+    u_section_number = urllib.parse.unquote(section_number)
+    doc = CODE.get_document(code, u_section_number)
+    if doc is None:
+        return jsonify(UTIL.failure_message(f"Section {u_section_number} of {code.upper()} not found", 'ERR_NOT_FOUND'))
+    message = UTIL.success_message()
+    message['data'] = doc
+    return jsonify(message)
+
+
 @code_routes.route('/codesearch/list/', methods=['GET'])
 def get_code_list():
     """
     Get a list of codified laws and their searchability flags.
-    This is a very slow function call because for each code configuration we find,
-    we query the index to see if there are any documents indexed into that code
-    section. To avoid doing that check every time, we cache the response and use
-    the cached response for every query for the next 30 minutes.
-
-    First, see if we have a cached response. If so, use it.
-    Otherwise, get a new response and cache it for 30 minutes.
-    """
-    key = '/codesearch/list/'
-    listing = redis_service.get(key)
-    if listing:
-        listing_list = json.loads(listing)
-    else:
-        listing_list = CODE.list_codes()
-        redis_service.set(key, json.dumps(listing_list))
-        redis_service.expire(key, 30*60)  # expire every 30 minutes
-    return jsonify(listing_list)
+    The listing is served from the in-memory code catalog, which is only
+    rebuilt when a new generation of the search index is loaded.
+    """
+    return jsonify(CODE.list_codes())
+
+
+@code_routes.route('/codesearch/cache/', methods=['GET'])
+def get_cache_stats():
+    """
+    Get hit/miss counters and size of the search result cache.
+    """
+    message = UTIL.success_message()
+    message['data'] = CODE.RESULT_CACHE.stats()
+    return jsonify(message)
+
+
+@code_routes.route('/codesearch/admin/refresh/', methods=['POST'])
+def refresh_index():
+    """
+    Download and publish a new search index in the background. Searches keep
+    running against the current index until the new one has been checked.
+    """
+    if not request.authorization or request.authorization.username not in ADMIN_USERS:
+        return jsonify(UTIL.failure_message("Not authorized", 'ERR_NOT_ADMIN'))
+    if not CODE.refresh_index_in_background():
+        return jsonify(UTIL.failure_message("Index refresh already in progress", 'ERR_IN_PROGRESS'))
+    message = UTIL.success_message()
+    message['message'] = "Index refresh started"
+    return jsonify(message)
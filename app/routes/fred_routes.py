@@ -5,6 +5,7 @@ Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 """
 import util.util as UTIL
 import services.fred as FRED
+from services.fred_cache import FRED_CACHE
 from flask import Blueprint, request, jsonify
 
 fred_routes = Blueprint('fred_routes', __name__, template_folder='templates')
@@ -20,3 +21,70 @@ def get_historical_rate(year, month, term):
     message['dataset'] = 'FRED'
     message['data'] = data
     return jsonify(message)
+
+
+@fred_routes.route('/fred/historical_rates/', methods=['GET'])
+def get_historical_rates():
+    """
+    Average mortgage rates for every month (or year) from start to end, for
+    one or more terms, e.g. ?start=2010-01&end=2020-12&terms=15,30&frequency=m
+    """
+    start = request.args.get('start')
+    end = request.args.get('end')
+    terms = request.args.get('terms')
+    frequency = request.args.get('frequency', 'm')
+    if not start or not end:
+        return jsonify(UTIL.failure_message("start and end are required", 'ERR_BAD_PARAMS'))
+    if terms:
+        terms = [term.strip() for term in terms.split(',') if term.strip()]
+    fred_service = FRED.FredUtil()
+    try:
+        rates = fred_service.average_fixed_mortgages(start, end, terms, frequency)
+    except ValueError as e:
+        return jsonify(UTIL.failure_message(str(e), 'ERR_BAD_PARAMS'))
+    params = {'start': start, 'end': end, 'terms': [rate['term'] for rate in rates], 'frequency': frequency}
+    data = {'query': 'historical_rates', 'params': params, 'response': rates}
+    message = UTIL.success_message()
+    message['dataset'] = 'FRED'
+    message['data'] = data
+    return jsonify(message)
+
+
+@fred_routes.route('/fred/series/<string:series_id>/', methods=['GET'])
+def get_series(series_id):
+    """
+    Observations of any FRED series, served from our local copy, e.g.
+    /fred/series/CPIAUCSL/?start=2015-01-01&end=2020-12-31&frequency=a&aggregation=avg
+    """
+    start = request.args.get('start')
+    end = request.args.get('end')
+    frequency = request.args.get('frequency') or None
+    aggregation = request.args.get('aggregation', 'avg')
+    fred_service = FRED.FredUtil()
+    try:
+        observations = fred_service.observations(series_id, start, end, frequency, aggregation)
+    except ValueError as e:
+        return jsonify(UTIL.failure_message(str(e), 'ERR_BAD_PARAMS'))
+    params = {
+        'series_id': series_id.upper(),
+        'start': start,
+        'end': end,
+        'frequency': frequency,
+        'aggregation': aggregation if frequency else None,
+    }
+    data = {'query': 'series', 'params': params, 'response': observations}
+    message = UTIL.success_message()
+    message['dataset'] = 'FRED'
+    message['data'] = data
+    return jsonify(message)
+
+
+@fred_routes.route('/fred/cache/', methods=['GET'])
+def get_cache_stats():
+    """
+    Get hit/miss counters for the FRED observation cache.
+    """
+    message = UTIL.success_message()
+    message['dataset'] = 'FRED'
+    message['data'] = FRED_CACHE.stats()
+    return jsonify(message)
@@ -0,0 +1,32 @@
+"""
+property_routes.py - Flask Routes for looking up a property in several sources at once.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import util.util as UTIL
+import services.public_data as PUBLIC_DATA
+import services.zillow as ZILLOW
+from services.upstream import fan_out
+from flask import Blueprint, jsonify
+
+property_routes = Blueprint('property_routes', __name__, template_folder='templates')
+
+
+@property_routes.route('/property/value/<string:street>/<string:city>/<string:state>/<string:zip_code>/', methods=['GET'])
+def get_property_value(street, city, state, zip_code):
+    """
+    Look a property up in Zillow and PublicData at the same time. A source
+    that fails has a null response; the other's is still returned.
+    """
+    zillow_service = ZILLOW.Zillow()
+    public_data_service = PUBLIC_DATA.PDTaxRecords()
+    responses = fan_out({
+        'zillow': lambda: zillow_service.search(street, f'{city} {state} {zip_code}'),
+        'public_data': lambda: public_data_service.search(street, city, state),
+    })
+    params = {'street': street, 'city': city, 'state': state, 'zip_code': zip_code}
+    data = {'query': 'property/value', 'params': params, 'response': responses}
+    message = UTIL.success_message()
+    message['dataset'] = 'ZILLOW,PUBLICDATA'
+    message['data'] = data
+    return jsonify(message)
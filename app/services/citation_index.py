@@ -0,0 +1,185 @@
+"""
+citation_index.py - Resolve citations such as "Fam. Code 6.502" or
+"153.001-153.015" straight to documents, without a full-text search.
+
+The CitationIndex for a generation of the search index is built by the code
+catalog in the same pass that counts documents. Exact citations are a dict
+lookup; ranges are found by bisecting each code's sections, sorted in
+section order.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import re
+
+SECTION = r'\d+[a-z]?(?:\.\d+[a-z]?)*'
+CITATION = re.compile(
+    r'^\s*(?:(?P<code>[a-z][a-z.&\' ]*?)\s*,?\s*)?'
+    r'(?:§+|secs?\.|sections?)?\s*'
+    r'(?P<start>' + SECTION + r')'
+    r'(?:\s*(?:-|–|—|to|through)\s*(?P<end>' + SECTION + r'))?\s*$',
+    re.IGNORECASE
+)
+
+# Words that can appear in a citation's code name without naming the code.
+NOISE_WORDS = {
+    'tex', 'texas', 'code', 'ann', 'annotated', 'vernon', "vernon's", 'vernons', 'and',
+    'sec', 'secs', 'section', 'sections'
+}
+
+Citation = namedtuple('Citation', 'code start end')
+
+
+def parse_citation(text: str) -> Citation:
+    """
+    Recognize a citation.
+
+    Args:
+        text (str): Text entered by the user, e.g. "Fam. Code § 6.502".
+    Returns:
+        (Citation): Code name as written (or None), first section, and last
+        section (or None), or None if the text is not a citation.
+    """
+    match = CITATION.match(text or '')
+    if match is None:
+        return None
+    code = match.group('code')
+    if code and not name_words(code):
+        code = None
+    return Citation(code and code.strip(), match.group('start').lower(), (match.group('end') or '').lower() or None)
+
+
+def section_key(section_number: str) -> tuple:
+    """
+    Sort key that puts section numbers in the order they appear in a code.
+    Chapters compare as numbers. The digits after a decimal point compare
+    as text, so 153.0071 falls between 153.007 and 153.008.
+
+    Args:
+        section_number (str): Section number, e.g. 153.009
+    Returns:
+        (tuple): Sort key.
+    """
+    parts = section_number.lower().strip().split('.')
+    match = re.match(r'(\d*)(.*)', parts[0])
+    chapter = (int(match.group(1)) if match.group(1) else -1, match.group(2))
+    return (chapter,) + tuple(parts[1:])
+
+
+def name_words(name: str) -> list:
+    """
+    Split a code name into the words that identify it.
+
+    Args:
+        name (str): Code name, e.g. "Tex. Civ. Prac. & Rem. Code"
+    Returns:
+        (list): Lower-case words, e.g. ['civ', 'prac', 'rem']
+    """
+    words = re.findall(r"[a-z']+", name.lower())
+    return [word for word in words if word not in NOISE_WORDS]
+
+
+class CitationIndex(object):
+    """
+    Citation lookups for one generation of the search index.
+    """
+
+    def __init__(self, generation: int, configs: dict):
+        """
+        Instance initializer.
+
+        Args:
+            generation (int): Index generation the document numbers belong to.
+            configs (dict): Code configurations keyed by lower-case code abbreviation.
+        """
+        self.generation = generation
+        self.exact = {}
+        self.keys = {}
+        self.docs = {}
+        self.names = {}
+        for code, config in configs.items():
+            self.names[code] = name_words(config.get('code_full_name', ''))
+            for alias in config.get('citation_names', []):
+                self.names.setdefault(f'{code}:{alias}', name_words(alias))
+        self._entries = {}
+
+    def add(self, code: str, section_number: str, docnum: int):
+        """
+        Add one document. Call finish() once every document has been added.
+
+        Args:
+            code (str): Lower-case code abbreviation.
+            section_number (str): Section number.
+            docnum (int): Document number.
+        """
+        if not section_number:
+            return
+        section_number = section_number.lower().strip()
+        self.exact.setdefault((code, section_number), []).append(docnum)
+        self._entries.setdefault(code, []).append((section_key(section_number), docnum))
+
+    def finish(self):
+        """
+        Sort each code's sections for range lookups.
+        """
+        for code, entries in self._entries.items():
+            entries.sort()
+            self.keys[code] = [key for key, docnum in entries]
+            self.docs[code] = [docnum for key, docnum in entries]
+        self._entries = {}
+
+    def resolve_code(self, name: str) -> str:
+        """
+        Find the code a citation refers to. A code can be named by its
+        abbreviation ("FA"), its full name ("Texas Family Code"), or the
+        usual citation form ("Tex. Fam. Code"), where each word may be
+        shortened.
+
+        Args:
+            name (str): Code name as written in the citation.
+        Returns:
+            (str): Lower-case code abbreviation or None if no code matches.
+        """
+        name = name.lower().strip(' .')
+        if name in self.keys:
+            return name
+        words = name_words(name)
+        if not words:
+            return None
+        for key, code_words in self.names.items():
+            if len(words) != len(code_words):
+                continue
+            if all(code_word.startswith(word.rstrip("'")) for word, code_word in zip(words, code_words)):
+                return key.split(':')[0]
+        return None
+
+    def lookup(self, citation: Citation, codes: tuple = ()) -> list:
+        """
+        Find the documents a citation refers to.
+
+        Args:
+            citation (Citation): Citation from parse_citation().
+            codes (tuple): Codes to look in when the citation does not name one. Empty for all.
+        Returns:
+            (list): Document numbers in code and section order, or None if
+            the citation names a code we do not have.
+        """
+        if citation.code:
+            code = self.resolve_code(citation.code)
+            if code is None:
+                return None
+            codes = [code]
+        else:
+            codes = [code.lower() for code in codes] or sorted(self.keys)
+
+        docnums = []
+        for code in codes:
+            if citation.end is None:
+                docnums.extend(self.exact.get((code, citation.start), []))
+                continue
+            keys = self.keys.get(code, [])
+            first = bisect_left(keys, section_key(citation.start))
+            last = bisect_right(keys, section_key(citation.end))
+            docnums.extend(self.docs[code][first:last])
+        return docnums
@@ -0,0 +1,298 @@
+"""
+code_catalog.py - In-memory catalog of the codes in the search index.
+
+A catalog is built with one pass over the stored documents each time a new
+generation of the index is loaded, so listing the codes never touches the
+index. Each snapshot keeps its own catalog while queries are using it. The same pass builds the citation index and the section names used
+for suggestions.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import glob
+import json
+import threading
+import weakref
+
+from whoosh.idsets import BitSet
+from whoosh.query import Or, Term
+
+import util.util as UTIL
+from services.citation_index import CitationIndex
+from services.code_index import CODE_INDEX, SnapshotRetired
+from services.suggest_index import SuggestIndex
+
+
+class Catalog(object):
+    """
+    Parsed code configurations and per-code document statistics for one
+    generation of the index.
+    """
+
+    def __init__(self, generation: int = None):
+        """
+        Instance initializer. The catalog is empty until build() fills it.
+
+        Args:
+            generation (int): Generation of the snapshot it describes.
+        """
+        self.generation = generation
+        self.configs = {}
+        self.stats = {}
+        self.code_docs = {}
+        self.citations = None
+        self.suggestions = None
+        self._filters = {}
+
+    def build(self, searcher):
+        """
+        Fill the catalog with one pass over the stored documents.
+
+        Args:
+            searcher (whoosh.searching.Searcher): Searcher for the snapshot.
+        Returns:
+            None
+        """
+        configs = load_code_configs()
+        stats = {}
+        code_docs = {}
+        citations = CitationIndex(self.generation, configs)
+        suggestions = SuggestIndex(self.generation)
+        doc_count = searcher.doc_count_all()
+        for docnum, fields in searcher.reader().iter_docs():
+            code = fields.get('code', '').lower()
+            code_stats = stats.setdefault(code, {'documents': 0, 'chapters': set(), 'sections': set()})
+            if code not in code_docs:
+                code_docs[code] = BitSet(size=doc_count)
+            code_docs[code].add(docnum)
+            code_stats['documents'] += 1
+            code_stats['chapters'].add(fields.get('chapter'))
+            code_stats['sections'].add(fields.get('section_number'))
+            citations.add(code, fields.get('section_number'), docnum)
+            suggestions.add_section_name(code, fields.get('section_name'))
+        suggestions.add_words(lexicon(searcher.reader(), 'text'))
+        citations.finish()
+        suggestions.finish()
+
+        self.configs = configs
+        self.stats = {
+            code: {
+                'documents': code_stats['documents'],
+                'chapters': len(code_stats['chapters']),
+                'sections': len(code_stats['sections']),
+            }
+            for code, code_stats in stats.items()
+        }
+        self.code_docs = code_docs
+        self.citations = citations
+        self.suggestions = suggestions
+
+    def code_stats(self, code_name: str) -> dict:
+        """
+        Get document statistics for a code.
+
+        Args:
+            code_name (str): Two-letter code abbreviation.
+        Returns:
+            (dict): Counts of documents, chapters, and sections.
+        """
+        return self.stats.get(code_name.lower(), {'documents': 0, 'chapters': 0, 'sections': 0})
+
+    def code_filter(self, codes: tuple) -> BitSet:
+        """
+        Get the documents in the given codes. The union for each combination
+        of codes is cached with the catalog.
+
+        Args:
+            codes (tuple): Lower-case code abbreviations.
+        Returns:
+            (whoosh.idsets.BitSet): Document numbers in this generation.
+        """
+        docs = self._filters.get(codes)
+        if docs is None:
+            docs = BitSet()
+            for code in codes:
+                docs = docs.union(self.code_docs.get(code, BitSet()))
+            self._filters[codes] = docs
+        return docs
+
+
+class CodeCatalog(object):
+    """
+    Catalogs of the snapshots of the index that are in use. Each snapshot's
+    catalog is built once, when the snapshot is loaded, and lives as long as
+    the snapshot, so a query still running on a replaced snapshot keeps using
+    the catalog that matches it.
+    """
+
+    def __init__(self):
+        """
+        Instance initializer.
+        """
+        self._catalogs = weakref.WeakKeyDictionary()
+        self._latest = Catalog()
+        self._lock = threading.Lock()
+
+    def load(self, snapshot):
+        """
+        Build the catalog for a snapshot of the index, unless it has one or
+        is older than the newest snapshot cataloged.
+
+        Args:
+            snapshot (Snapshot): Snapshot from CODE_INDEX.
+        Returns:
+            None
+        """
+        with self._lock:
+            if snapshot in self._catalogs:
+                return
+            if self._latest.generation is not None and snapshot.generation < self._latest.generation:
+                return
+            try:
+                searcher = snapshot.acquire()
+            except SnapshotRetired:
+                # Replaced already; its replacement will be cataloged.
+                return
+            try:
+                catalog = Catalog(snapshot.generation)
+                catalog.build(searcher)
+            finally:
+                snapshot.release()
+            self._catalogs[snapshot] = catalog
+            self._latest = catalog
+            UTIL.logmessage(f"Cataloged {len(catalog.stats)} codes for index generation {catalog.generation}")
+
+    def catalog(self, snapshot) -> Catalog:
+        """
+        Get the catalog for a snapshot, building it if the snapshot is the
+        newest one we have seen.
+
+        Args:
+            snapshot (Snapshot): Snapshot being searched.
+        Returns:
+            (Catalog): Catalog whose document numbers belong to the snapshot,
+            or None if the snapshot was replaced before it was cataloged.
+        """
+        catalog = self._catalogs.get(snapshot)
+        if catalog is None:
+            self.load(snapshot)
+            catalog = self._catalogs.get(snapshot)
+        return catalog
+
+    def current(self) -> Catalog:
+        """
+        Get the catalog for the current generation of the index.
+
+        Returns:
+            (Catalog): The catalog.
+        """
+        with CODE_INDEX.hold() as snapshot:
+            return self.catalog(snapshot) or self._latest
+
+    def has_documents(self, snapshot, codes: tuple) -> bool:
+        """
+        See if any of the given codes has documents in the index.
+
+        Args:
+            snapshot (Snapshot): Snapshot being searched.
+            codes (tuple): Code abbreviations. Empty for all codes.
+        Returns:
+            (bool): True if a search limited to the codes could match anything.
+        """
+        if not codes:
+            return True
+        catalog = self.catalog(snapshot) or self._latest
+        return any(catalog.code_stats(code)['documents'] for code in codes)
+
+    def code_filter(self, snapshot, codes: tuple):
+        """
+        Get a filter that limits a search to documents in the given codes.
+        The per-code document sets are built when the catalog is loaded.
+
+        Whoosh treats an empty filter as no filter at all, so check
+        has_documents() first.
+
+        Args:
+            snapshot (Snapshot): Snapshot being searched.
+            codes (tuple): Code abbreviations. Empty for all codes.
+        Returns:
+            (whoosh.idsets.BitSet): Allowed document numbers, None if not filtering.
+        """
+        if not codes:
+            return None
+        key = tuple(code.lower() for code in codes)
+        catalog = self.catalog(snapshot)
+        if catalog is None:
+            # The snapshot was never cataloged. Fall back to an unscored
+            # query filter.
+            return Or([Term('code', code) for code in key])
+        return catalog.code_filter(key)
+
+    def citation_index(self, snapshot) -> CitationIndex:
+        """
+        Get the citation index for a snapshot of the index.
+
+        Args:
+            snapshot (Snapshot): Snapshot being searched.
+        Returns:
+            (CitationIndex): Citation index whose document numbers belong to
+            the snapshot, or None if the snapshot was never cataloged.
+        """
+        catalog = self.catalog(snapshot)
+        return catalog.citations if catalog is not None else None
+
+    def suggest_index(self, snapshot) -> SuggestIndex:
+        """
+        Get the suggestions for a snapshot of the index.
+
+        Args:
+            snapshot (Snapshot): Current snapshot.
+        Returns:
+            (SuggestIndex): Suggestions built from the snapshot, or from the
+            newest snapshot if this one was never cataloged.
+        """
+        catalog = self.catalog(snapshot) or self._latest
+        if catalog.suggestions is None:
+            suggestions = SuggestIndex(snapshot.generation)
+            suggestions.finish()
+            return suggestions
+        return catalog.suggestions
+
+
+def lexicon(reader, field_name: str):
+    """
+    List the words indexed in a field.
+
+    Args:
+        reader (whoosh.reading.IndexReader): Index reader.
+        field_name (str): Field name.
+    Yields:
+        (str, int): Each word and the number of documents containing it.
+    """
+    if field_name not in reader.indexed_field_names():
+        return
+    field = reader.schema[field_name]
+    for word, term_info in reader.iter_field(field_name):
+        yield (field.from_bytes(word), term_info.doc_frequency())
+
+
+def load_code_configs() -> dict:
+    """
+    Load every code configuration file in CODE_PATH.
+
+    Args:
+        None
+    Returns:
+        (dict): Configurations keyed by lower-case code abbreviation.
+    """
+    code_path = UTIL.get_env('CODE_PATH')
+    configs = {}
+    for code_file in sorted(glob.glob(f'{code_path}/??.json')):
+        with open(code_file, 'r') as fp:
+            config = json.load(fp)
+        configs[config['code_name'].lower()] = config
+    return configs
+
+
+# The one catalog for this process.
+CODE_CATALOG = CodeCatalog()
+CODE_INDEX.on_change(CODE_CATALOG.load)
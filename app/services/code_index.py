@@ -0,0 +1,454 @@
+"""
+code_index.py - Process-wide manager for the code search index.
+
+Opening a Whoosh index means reading the TOC and opening every segment, so
+we do that once per process and hand out searchers from the open index.
+Searchers are kept per-thread and are only replaced when the generation of
+the index on disk changes or a new version of the index is published.
+
+When the index is sharded by code (INDEX_SHARDED=Y), each thread's searcher
+reads every shard through one MultiReader, so term statistics are shared
+across shards and scores are the same as they would be in a single index.
+search_shards() searches several shards in parallel and merges the hits.
+
+Section bodies are read from the snapshot's document store (util.doc_store)
+when the index has one. Older indexes store the bodies in the index itself.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import time
+
+from whoosh.index import open_dir
+from whoosh.qparser import MultifieldParser, QueryParser
+from whoosh.reading import MultiReader
+from whoosh.searching import Searcher
+
+from services.search_limits import BoundedFuzzyTermPlugin, collect
+from util.doc_store import DocStore, exists_in as docs_exist_in
+import util.functions as FN
+import util.util as UTIL
+
+# How often, in seconds, we look at the index directory for a new generation.
+CHECK_SECONDS = int(UTIL.get_env('INDEX_CHECK_SECONDS', 30))
+
+# Threads used to search shards in parallel
+SHARD_WORKERS = int(UTIL.get_env('INDEX_SHARD_WORKERS', 4))
+
+SEARCH_FIELDS = ['section_name', 'text', 'section_number']
+
+
+class SnapshotRetired(Exception):
+    """
+    Raised when a searcher is asked for on a snapshot that has been replaced
+    and closed. Ask CODE_INDEX for the current snapshot instead.
+    """
+
+
+class ShardSearcher(Searcher):
+    """
+    Searcher for one shard that takes its term statistics from a parent
+    searcher over every shard.
+    """
+
+    def avg_field_length(self, fieldname, default=None):
+        if self.has_parent():
+            return self.get_parent().avg_field_length(fieldname, default)
+        return Searcher.avg_field_length(self, fieldname, default)
+
+
+class Snapshot(object):
+    """
+    One generation of the index and the searchers opened against it.
+    """
+
+    def __init__(self, indexes: dict, path: str, generation: int):
+        """
+        Instance initializer.
+
+        Args:
+            indexes (dict): Open indexes keyed by index name.
+            path (str): Directory the indexes were opened from.
+            generation (int): Our generation number for this snapshot.
+        """
+        self.indexes = indexes
+        self.path = path
+        self.generation = generation
+        self.sharded = FN.SHARDED
+        self.shards = sorted(indexes) if self.sharded else []
+        self.toc_generation = toc_state(indexes)
+        self.docs = DocStore(path) if docs_exist_in(path) else None
+        self.loaded = time.time()
+        self._offsets = None
+        self._searchers = {}
+        self._shard_readers = {}
+        self._active = 0
+        self._retired = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Get the searcher belonging to the calling thread, opening one if needed.
+        Every call must be matched by a call to release(). A retired snapshot
+        can still be acquired by a query that already holds it, e.g. for a
+        shard search or a batch, but not by a new one.
+
+        Returns:
+            (whoosh.searching.Searcher): Searcher for this snapshot.
+        Raises:
+            SnapshotRetired: If the snapshot has been replaced and closed.
+        """
+        key = threading.get_ident()
+        with self._lock:
+            if self._retired and self._active == 0:
+                raise SnapshotRetired(f"Index generation {self.generation} has been replaced")
+            self._active += 1
+            searcher = self._searchers.get(key)
+            if searcher is None:
+                searcher = self._open_searcher(key)
+                self._searchers[key] = searcher
+        return searcher
+
+    def _open_searcher(self, key):
+        """
+        Open a searcher over every index in this snapshot. Caller must hold the lock.
+        """
+        if not self.sharded:
+            return self.indexes[FN.MAIN_INDEX].searcher()
+
+        shard_readers = {}
+        offsets = {}
+        leaves = []
+        base = 0
+        for name in self.shards:
+            reader = self.indexes[name].reader()
+            shard_readers[name] = reader
+            offsets[name] = base
+            base += reader.doc_count_all()
+            leaves.extend(leaf for leaf, offset in reader.leaf_readers())
+        self._shard_readers[key] = shard_readers
+        self._offsets = offsets
+        return Searcher(MultiReader(leaves))
+
+    def shard_offset(self, name: str) -> int:
+        """
+        Get the first document number of a shard in the combined searcher.
+        The caller must have acquired a searcher.
+
+        Args:
+            name (str): Shard name.
+        Returns:
+            (int): Document number offset.
+        """
+        return self._offsets[name]
+
+    def shard_searcher(self, name: str):
+        """
+        Get a searcher for one shard that uses the calling thread's combined
+        searcher for term statistics. The caller must have acquired the
+        combined searcher.
+
+        Args:
+            name (str): Shard name.
+        Returns:
+            (ShardSearcher): Searcher for the shard.
+        """
+        key = threading.get_ident()
+        parent = self._searchers[key]
+        reader = self._shard_readers[key][name]
+        return ShardSearcher(reader, closereader=False, parent=parent)
+
+    def bodies(self, hit) -> dict:
+        """
+        Get the text and source text of a hit.
+
+        Args:
+            hit (whoosh.searching.Hit): Search hit from this snapshot.
+        Returns:
+            (dict): 'text' and 'source_text', where available.
+        """
+        fields = hit.fields()
+        if self.docs is None or 'body_id' not in fields:
+            return {name: fields[name] for name in ('text', 'source_text') if name in fields}
+        try:
+            text, source_text = self.docs.get(fields['body_id'])
+        except KeyError:
+            # The index refers to a body the store did not have when we
+            # opened it. Serve the rest of the hit rather than fail the search.
+            UTIL.logmessage(f"No body {fields['body_id']} in the document store for {self.path}")
+            return {}
+        return {'text': text, 'source_text': source_text}
+
+    def release(self):
+        """
+        Give back a searcher obtained from acquire(). The last release of a
+        retired snapshot closes it.
+        """
+        with self._lock:
+            self._active -= 1
+            done = self._retired and self._active == 0
+        if done:
+            self.close()
+
+    def retire(self):
+        """
+        Mark this snapshot as replaced. It is closed as soon as the queries
+        still running against it have finished.
+        """
+        with self._lock:
+            self._retired = True
+            done = self._active == 0
+        if done:
+            self.close()
+
+    def close(self):
+        """
+        Close every searcher opened against this snapshot, and the document store.
+        """
+        with self._lock:
+            searchers = list(self._searchers.values())
+            self._searchers = {}
+            self._shard_readers = {}
+            docs = self.docs
+            self.docs = None
+        for searcher in searchers:
+            try:
+                searcher.close()
+            except Exception as e:
+                UTIL.logmessage(f"Error closing searcher: {str(e)}")
+        if docs is not None:
+            docs.close()
+
+
+class CodeIndex(object):
+    """
+    Keeps the code search index open for the life of the process.
+    """
+
+    def __init__(self, index_path: str = None):
+        """
+        Instance initializer.
+
+        Args:
+            index_path (str): Directory holding the index. Defaults to the
+                              version named by FN.current_index_path().
+        """
+        self.index_path = index_path
+        self.schema = FN.schema()
+        self.parser = MultifieldParser(SEARCH_FIELDS, schema=self.schema)
+        self.parser.add_plugin(BoundedFuzzyTermPlugin())
+        self.code_parser = QueryParser('code', schema=self.schema)
+        self._snapshot = None
+        self._generation = 0
+        self._last_check = 0
+        self._listeners = []
+        self._lock = threading.RLock()
+
+    @property
+    def generation(self) -> int:
+        """
+        Generation of the index as seen by this process. It changes every time
+        we pick up a new version of the index, so it is safe to use in cache keys.
+        """
+        return self.snapshot().generation
+
+    def on_change(self, callback):
+        """
+        Register a callback to be run whenever a new generation is loaded.
+
+        Args:
+            callback (function): Called with the new Snapshot.
+        """
+        self._listeners.append(callback)
+
+    def snapshot(self) -> Snapshot:
+        """
+        Get the current snapshot, opening the index or picking up a new
+        generation from disk if needed.
+
+        Returns:
+            (Snapshot): Current snapshot.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and time.time() - self._last_check < CHECK_SECONDS:
+            return snapshot
+        return self.refresh()
+
+    def refresh(self, force: bool = False) -> Snapshot:
+        """
+        Load a new snapshot if the index on disk has changed or a new
+        version of the index has been published. Queries running against
+        the old snapshot finish on it; it is closed once they are done.
+
+        Args:
+            force (bool): Reopen the index even if the generation looks unchanged.
+        Returns:
+            (Snapshot): Current snapshot.
+        """
+        with self._lock:
+            self._last_check = time.time()
+            current = self._snapshot
+            path = self.index_path or FN.current_index_path()
+            if current is not None and not force and current.path == path:
+                if FN.index_names(path) == sorted(current.indexes):
+                    if toc_state(current.indexes) == current.toc_generation:
+                        return current
+
+            indexes = open_indexes(path)
+            self._generation += 1
+            snapshot = Snapshot(indexes, path, self._generation)
+            self._snapshot = snapshot
+            UTIL.logmessage(f"Loaded index generation {snapshot.toc_generation} from {path}")
+
+        if current is not None:
+            current.retire()
+        for callback in self._listeners:
+            callback(snapshot)
+        return snapshot
+
+    def acquire(self, snapshot: Snapshot = None) -> (Snapshot, Searcher):
+        """
+        Acquire a searcher on a snapshot. Without a snapshot, the current one
+        is used; if it is replaced and closed before we can acquire it, we
+        move on to its replacement. Every call must be matched by a call to
+        the snapshot's release().
+
+        Args:
+            snapshot (Snapshot): Snapshot to search. Defaults to the current one.
+        Returns:
+            (Snapshot, whoosh.searching.Searcher): The snapshot and its searcher.
+        Raises:
+            SnapshotRetired: If the given snapshot has been closed.
+        """
+        if snapshot is not None:
+            return (snapshot, snapshot.acquire())
+        while True:
+            snapshot = self.snapshot()
+            try:
+                return (snapshot, snapshot.acquire())
+            except SnapshotRetired:
+                # refresh() makes the new snapshot current before retiring
+                # the old one, so the next look finds the new one.
+                continue
+
+    @contextmanager
+    def hold(self, snapshot: Snapshot = None):
+        """
+        Context manager that yields a snapshot, current unless one is given,
+        and keeps it open until the block exits, even if a new generation is
+        loaded in the meantime. Hold the snapshot for the whole of a request
+        that uses it more than once, e.g. for a code filter and a search.
+
+        Args:
+            snapshot (Snapshot): Snapshot to hold. Defaults to the current one.
+        """
+        snapshot, searcher = self.acquire(snapshot)
+        try:
+            yield snapshot
+        finally:
+            snapshot.release()
+
+    @contextmanager
+    def searcher(self, snapshot: Snapshot = None):
+        """
+        Context manager that yields a searcher for the current snapshot.
+
+        The searcher stays open after the block exits so the next request
+        on this thread can reuse it.
+
+        Args:
+            snapshot (Snapshot): Snapshot to search. Defaults to the current one.
+        """
+        snapshot, searcher = self.acquire(snapshot)
+        try:
+            yield searcher
+        finally:
+            snapshot.release()
+
+
+def open_indexes(index_path: str) -> dict:
+    """
+    Open every index in an index directory.
+
+    Args:
+        index_path (str): Index directory.
+    Returns:
+        (dict): Open indexes keyed by index name.
+    """
+    names = FN.index_names(index_path)
+    if not names:
+        raise FileNotFoundError(f"No indexes found in {index_path}")
+    return {name: open_dir(index_path, name) for name in names}
+
+
+def toc_state(indexes: dict) -> tuple:
+    """
+    Get the on-disk generation of every index, so we can tell when any
+    of them has changed.
+
+    Args:
+        indexes (dict): Open indexes keyed by index name.
+    Returns:
+        (tuple): (name, generation) pairs.
+    """
+    return tuple((name, indexes[name].latest_generation()) for name in sorted(indexes))
+
+
+def search_shards(snapshot: Snapshot, query, shards: list, limit: int, groupedby: dict = None) -> (list, int, bool, dict):
+    """
+    Search shards in parallel and merge their hits. Every shard is scored
+    with term statistics from the whole index, so the scores can be
+    compared directly.
+
+    Args:
+        snapshot (Snapshot): Sharded snapshot to search.
+        query (whoosh.query.Query): Parsed query.
+        shards (list): Names of the shards to search.
+        limit (int): Most hits to return.
+        groupedby (dict): Whoosh facets keyed by name, to count hits by.
+    Returns:
+        (list, int, bool, dict): Top (score, docnum) pairs, with document
+        numbers in the combined searcher, the total number of matches, True
+        if any shard ran out of time, and hit counts for each facet.
+    """
+    futures = [SHARD_POOL.submit(_search_shard, snapshot, name, query, limit, groupedby) for name in shards]
+    top_n = []
+    total = 0
+    truncated = False
+    groups = {name: {} for name in groupedby or {}}
+    for future in futures:
+        shard_top_n, shard_total, shard_truncated, shard_groups = future.result()
+        top_n.extend(shard_top_n)
+        total += shard_total
+        truncated = truncated or shard_truncated
+        for name, counts in shard_groups.items():
+            for key, count in counts.items():
+                groups[name][key] = groups[name].get(key, 0) + count
+
+    # Same order Whoosh uses: highest score first, then lowest document number
+    top_n.sort(key=lambda hit: (-hit[0], hit[1]))
+    return (top_n[:limit], total, truncated, groups)
+
+
+def _search_shard(snapshot: Snapshot, name: str, query, limit: int, groupedby: dict) -> (list, int, bool, dict):
+    """
+    Search one shard on a worker thread, using that thread's own readers.
+    """
+    snapshot.acquire()
+    try:
+        offset = snapshot.shard_offset(name)
+        searcher = snapshot.shard_searcher(name)
+        results, truncated = collect(searcher, query, limit, groupedby=groupedby)
+        top_n = [(score, offset + docnum) for score, docnum in results.top_n]
+        groups = {name: results.groups(name) for name in groupedby or {}}
+        return (top_n, len(results), truncated, groups)
+    finally:
+        snapshot.release()
+
+
+SHARD_POOL = ThreadPoolExecutor(max_workers=SHARD_WORKERS, thread_name_prefix='shard')
+
+# The one index manager for this process.
+CODE_INDEX = CodeIndex()
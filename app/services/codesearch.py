@@ -3,34 +3,86 @@ codesearch.py - Search codified laws
 
 Copyright (c) by Thomas J. Daley, J.D.
 """
-import glob
 import os
+from bisect import bisect_right
 import util.functions as FN
 import shutil
-from whoosh.index import open_dir
-from whoosh.qparser import MultifieldParser, FuzzyTermPlugin, QueryParser
+import threading
+import time
 from collections import namedtuple
-import json
 import util.util as UTIL
-import boto3
+from services.citation_index import Citation, parse_citation
+from services.code_catalog import CODE_CATALOG
+from services.code_index import CODE_INDEX, open_indexes, search_shards
+from services.search_limits import collect
+from util.cache import LruCache
+from whoosh.query import NullQuery
+from whoosh.searching import Results, ResultsPage
+from whoosh.sorting import FieldFacet, StoredFieldFacet
+import services.s3_archive as S3
 from botocore.exceptions import ClientError, NoCredentialsError
+from concurrent.futures import ThreadPoolExecutor
 
 VERSION = '0.0.3'
 DEBUG = UTIL.get_env_bool('FLASK_DEBUG', False)
+PAGE_LENGTH = int(UTIL.get_env('SEARCH_PAGE_LENGTH', 20))
+SUGGEST_LIMIT = int(UTIL.get_env('SUGGEST_LIMIT', 10))
+
+# Hits returned by an unpaged search unless the caller asks for more
+SEARCH_LIMIT = int(UTIL.get_env('SEARCH_LIMIT', 10))
+
+# Fields of a document returned by search(), in the order we return them,
+# and the value to return when a stored field is missing.
+FIELDS = (
+    'code', 'code_name', 'title', 'subtitle', 'chapter', 'subchapter',
+    'section_prefix', 'section_number', 'section_name', 'text', 'source_text',
+    'future_effective_date', 'highlights', 'filename', 'version'
+)
+FIELD_DEFAULTS = {
+    'code': "NO CODE",
+    'code_name': "NO CODE NAME",
+    'title': "NO TITLE",
+    'subtitle': "NO SUBTITLE",
+    'chapter': "NO CHAPTER",
+    'subchapter': "NO SUBCHAPTER",
+    'section_prefix': 'Sec.',
+    'section_number': "NO SECTION NUMBER",
+    'section_name': "NO SECTION NAME",
+    'text': "NO TEXT",
+    'source_text': "NO SOURCE TEXT",
+    'future_effective_date': "N/A",
+}
+
+# Fields whose hit counts search() can return
+FACETS = ('code', 'title', 'chapter')
+
+# Fields that need the section's text from the document store.
+BODY_FIELDS = {'text', 'source_text', 'highlights'}
+
+# Number of downloaded index versions to keep on disk
+KEEP_VERSIONS = int(UTIL.get_env('INDEX_KEEP_VERSIONS', 3))
+DOWNLOAD_LOCK = threading.Lock()
+
+# Search results keyed by canonical query, code list, and index generation.
+RESULT_CACHE = LruCache(
+    max_bytes=int(UTIL.get_env('SEARCH_CACHE_MB', 64)) * 1024 * 1024,
+    ttl=int(UTIL.get_env('SEARCH_CACHE_SECONDS', 60*60))
+)
+CODE_INDEX.on_change(RESULT_CACHE.clear)
 
 
 def list_codes():
     """
     Retrieve a list of searchable codes.
+
+    The list is built from the in-memory code catalog, which is refreshed
+    whenever a new generation of the index is loaded.
     """
-    code_path = UTIL.get_env('CODE_PATH')
-    files = glob.glob(f'{code_path}/??.json')
+    catalog = CODE_CATALOG.current()
     codes = []
-    for code_file in files:
-        with open(code_file, 'r') as fp:
-            config = json.load(fp)
-        code_name = config['code_name']
-        if is_searchable(code_name):
+    for code_name, config in catalog.configs.items():
+        stats = catalog.code_stats(code_name)
+        if stats['documents'] > 0:
             searchable = 'Y'
         else:
             searchable = 'N'
@@ -39,11 +91,14 @@ def list_codes():
             shortname = config['code_full_name'].replace('Texas', '').replace('Code of', '').replace('Code', '').strip()
         codes.append(
             {
-                'code': code_name,
+                'code': config['code_name'],
                 'code_name': config['code_full_name'],
                 'version': VERSION,
                 'searchable': searchable,
-                'code_short_name': shortname
+                'code_short_name': shortname,
+                'documents': stats['documents'],
+                'chapters': stats['chapters'],
+                'sections': stats['sections']
             }
         )
     return codes
@@ -59,121 +114,774 @@ def is_searchable(code_name: str) -> bool:
     Returns:
         (bool): True if there is at least one article, otherwise False
     """
-    parser = QueryParser('code', schema=FN.schema())
-    query = parser.parse(code_name.lower())
-    index = open_dir(FN.INDEX_PATH, FN.index_name(None))
-    with index.searcher() as searcher:
-        result = searcher.search(query, limit=1)
-    return result.scored_length() > 0
+    return CODE_CATALOG.current().code_stats(code_name)['documents'] > 0
 
 
-def search(query_text, code_list):
+def search(query_text, code_list, page: int = None, pagelen: int = None, fields: list = None, limit: int = None, snapshot=None,
+           facets: list = None):
     """
     Search codified laws, returning the results.
 
     Args:
         query (str): Query string entered by user.
         code_list (str): Space-delimited list of codes to search or '*' or '' for ALL.
+        page (int): Page number, starting at 1. If omitted, the top hits are returned.
+        pagelen (int): Documents per page. Defaults to PAGE_LENGTH.
+        fields (list): Document fields to return. Defaults to all of FIELDS.
+        limit (int): Number of top hits to return when not paging. Defaults to SEARCH_LIMIT.
+        snapshot (Snapshot): Snapshot to search. Defaults to the current one.
+        facets (list): Names from FACETS to count every hit by, e.g. ['code', 'chapter'].
+    Returns:
+        (dict): Query, count, and list of matching documents, plus hit counts
+        under 'facets' if any were requested.
+    """
+    # The snapshot is held for the whole search, so it is not closed between
+    # building the code filter and searching if a new generation is loaded.
+    with CODE_INDEX.hold(snapshot) as snapshot:
+        return _search(query_text, code_list, page, pagelen, fields, limit, snapshot, facets)
+
+
+def _search(query_text, code_list, page: int, pagelen: int, fields: list, limit: int, snapshot, facets: list):
+    """
+    Search a snapshot the caller holds. See search().
+    """
+    limit = max(int(limit or SEARCH_LIMIT), 1)
+
+    # Citations are looked up directly instead of searched for
+    cited = cite(query_text, code_list, page, pagelen, fields, limit, snapshot, facets)
+    if cited is not None:
+        return cited
+
+    fields = select_fields(fields)
+    facets = select_facets(facets)
+    page, pagelen = page_args(page, pagelen)
+    query_text, query, codes = parse_query(query_text, code_list)
+
+    # Repeat searches are served from the result cache
+    cache_key = (str(query), codes, page, pagelen, fields, limit, facets, snapshot.generation)
+    cached = RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        return dict(cached, query_text=query_text)
+
+    # Codes we have never indexed match nothing.
+    if not CODE_CATALOG.has_documents(snapshot, codes):
+        return no_hits(query_text, query, page, pagelen, facets)
+
+    # Search for results. Only the hits on the requested page are loaded and
+    # highlighted; the total comes from counting matches, not loading them.
+    codes_filter = None
+    if not snapshot.sharded:
+        codes_filter = CODE_CATALOG.code_filter(snapshot, codes)
+    with CODE_INDEX.searcher(snapshot) as searcher:
+        groupedby = facet_groups(searcher, facets)
+        hits, result, truncated, groups = run_query(searcher, query, page, pagelen, limit, codes_filter, snapshot, codes, groupedby)
+        documents = [document(hit, fields, snapshot) for hit in hits]
+        total = len(result)
+
+    result = summary(query_text, query, len(documents), total, page, pagelen, truncated)
+    if groups is not None:
+        result['facets'] = groups
+    result['documents'] = documents
+    if not truncated:
+        RESULT_CACHE.put(cache_key, result)
+    return result
+
+
+def iter_search(query_text, code_list, page: int = None, pagelen: int = None, fields: list = None, facets: list = None):
+    """
+    Search codified laws, yielding each matching document as soon as it is
+    loaded, followed by a summary of the search. Without a page, every hit
+    is returned, not just the top hits.
+
+    The searcher stays open until the generator is exhausted or closed.
+
+    Args:
+        Same as search().
+    Yields:
+        (dict): One document per hit, then a summary with 'summary' set to True.
+    """
+    cited = cite(query_text, code_list, page, pagelen, fields, facets=facets)
+    if cited is not None:
+        for doc in cited.pop('documents'):
+            yield doc
+        cited['summary'] = True
+        yield cited
+        return
+
+    fields = select_fields(fields)
+    facets = select_facets(facets)
+    page, pagelen = page_args(page, pagelen)
+    query_text, query, codes = parse_query(query_text, code_list)
+
+    count = 0
+    with CODE_INDEX.hold() as snapshot:
+        if not CODE_CATALOG.has_documents(snapshot, codes):
+            result = no_hits(query_text, query, page, pagelen, facets)
+            del result['documents']
+            result['summary'] = True
+            yield result
+            return
+        codes_filter = CODE_CATALOG.code_filter(snapshot, codes)
+        with CODE_INDEX.searcher(snapshot) as searcher:
+            groupedby = facet_groups(searcher, facets)
+            hits, result, truncated, groups = run_query(searcher, query, page, pagelen, None, codes_filter, groupedby=groupedby)
+            for hit in hits:
+                count += 1
+                yield document(hit, fields, snapshot)
+            total = len(result)
+
+    result = summary(query_text, query, count, total, page, pagelen, truncated)
+    if groups is not None:
+        result['facets'] = groups
+    result['summary'] = True
+    yield result
+
+
+def cite(citation_text: str, code_list: str = '*', page: int = None, pagelen: int = None, fields: list = None,
+         limit: int = None, snapshot=None, facets: list = None):
+    """
+    Look up the sections a citation refers to, e.g. "153.009",
+    "Fam. Code 6.502", or "153.001-153.015". Ranges are returned in
+    section order.
+
+    Args:
+        citation_text (str): Citation entered by the user.
+        code_list (str): Codes to look in if the citation does not name one. Same as search().
+        page (int): Page number, starting at 1. If omitted, every section is returned.
+        pagelen (int): Documents per page. Defaults to PAGE_LENGTH.
+        fields (list): Document fields to return. Defaults to all of FIELDS.
+        limit (int): Most sections to return when not paging. None for all.
+        snapshot (Snapshot): Snapshot to search. Defaults to the current one.
+        facets (list): Names from FACETS to count every cited section by.
+    Returns:
+        (dict): Same as search(), with 'citation' set to True, or None if
+        the text is not a citation or no section matches it.
+    """
+    citation = parse_citation(citation_text)
+    if citation is None:
+        return None
+    fields = select_fields(fields)
+    facets = select_facets(facets)
+    page, pagelen = page_args(page, pagelen)
+    codes = parse_codes(code_list)
+
+    # The document numbers from the citation index belong to the snapshot,
+    # so it is held until the documents are loaded.
+    with CODE_INDEX.hold(snapshot) as snapshot:
+        citations = CODE_CATALOG.citation_index(snapshot)
+        if citations is None:
+            return None
+        docnums = citations.lookup(citation, codes)
+        if not docnums:
+            return None
+
+        total = len(docnums)
+        with CODE_INDEX.searcher(snapshot) as searcher:
+            groups = None
+            if facets:
+                groups = facet_counts(searcher, facet_groups(searcher, facets), docnums)
+            if page is not None:
+                docnums = docnums[(page - 1) * pagelen:page * pagelen]
+            elif limit:
+                docnums = docnums[:limit]
+            hits = Results(searcher, NullQuery, [(None, docnum) for docnum in docnums])
+            documents = [document(hit, fields, snapshot) for hit in hits]
+
+    sections = '-'.join(part for part in (citation.start, citation.end) if part)
+    query = f'{citation.code} {sections}' if citation.code else sections
+    result = summary(citation_text, query, len(documents), total, page, pagelen)
+    result['citation'] = True
+    if groups is not None:
+        result['facets'] = groups
+    result['documents'] = documents
+    return result
+
+
+def batch_search(queries: list) -> list:
+    """
+    Run many searches in one call. Every query runs against the same
+    snapshot of the index, and on this thread's searcher, so the batch sees
+    one consistent version of the index even if a new one is published
+    part way through.
+
+    The queries run one after another. Scoring is pure Python, so running
+    them on several threads would only add contention for the GIL; sharded
+    searches still fan out across shards.
+
+    Args:
+        queries (list): Dicts with 'query' and optional 'codes' (string or
+                        list), 'limit', 'page', 'pagelen', 'fields', and
+                        'facets' (list or comma-separated string).
+    Returns:
+        (list): One result per query, in order, each with 'elapsed_ms'. A
+        query that cannot be run gets a failure message instead.
+    """
+    with CODE_INDEX.hold() as snapshot:
+        results = []
+        for item in queries:
+            started = time.perf_counter()
+            results.append(dict(batch_item(item, snapshot), elapsed_ms=round((time.perf_counter() - started) * 1000, 3)))
+        return results
+
+
+def batch_item(item: dict, snapshot) -> dict:
+    """
+    Run one query of a batch.
+
     Returns:
-        (list): List of SearchResult tuples
-    """
-    parser = MultifieldParser(['section_name', 'text', 'section_number'], schema=FN.schema())
-    parser.add_plugin(FuzzyTermPlugin())
-    index = open_dir(FN.INDEX_PATH, FN.index_name(None))
-
-    # create code clause if user is narrowing the query to a subset of all
-    # indexed codes.
-    if code_list != '*' and code_list != '':
-        codes = code_list.upper().split(' ')
-        code_clauses = [f'code:{c} ' for c in codes]
-        code_clause = ' OR '.join(code_clauses)
-        query_text = query_text + ' ' + code_clause
-        if DEBUG:
-            UTIL.logmessage(f"Code Clause: {code_clause}")
+        (dict): Search result or failure message.
+    """
+    if not isinstance(item, dict) or not isinstance(item.get('query'), str) or not item['query'].strip():
+        return UTIL.failure_message("Each batch entry needs a query", 'ERR_BAD_QUERY')
+    codes = item.get('codes') or '*'
+    if isinstance(codes, list):
+        codes = ' '.join(codes)
+    try:
+        return search(
+            item['query'], codes,
+            page=item.get('page'), pagelen=item.get('pagelen'),
+            fields=name_list(item.get('fields')), limit=item.get('limit'), snapshot=snapshot,
+            facets=name_list(item.get('facets'))
+        )
+    except (TypeError, ValueError) as e:
+        return UTIL.failure_message(str(e), 'ERR_BAD_QUERY')
+
+
+def name_list(names) -> list:
+    """
+    Accept field or facet names as a list or as a comma-separated string.
+    """
+    if isinstance(names, str):
+        return [name.strip() for name in names.split(',') if name.strip()]
+    return names
+
+
+def suggest(prefix: str, code_list: str = '*', limit: int = None) -> dict:
+    """
+    Suggest completions for a query as it is typed: words from the index
+    vocabulary, most frequent first, and section names.
+
+    Args:
+        prefix (str): Text typed so far.
+        code_list (str): Codes whose section names to suggest. Same as search().
+                         Words are suggested from every code.
+        limit (int): Most suggestions of each kind. Defaults to SUGGEST_LIMIT.
+    Returns:
+        (dict): The prefix, suggested 'words', and 'section_names'.
+    """
+    limit = max(int(limit or SUGGEST_LIMIT), 1)
+    key = ' '.join(prefix.lower().split())
+    if prefix.endswith(' '):
+        key += ' '
+    with CODE_INDEX.hold() as snapshot:
+        suggestions = CODE_CATALOG.suggest_index(snapshot)
+    return {
+        'prefix': prefix,
+        'words': suggestions.suggest_words(key, limit),
+        'section_names': suggestions.suggest_names(key.strip(), parse_codes(code_list), limit),
+        'version': VERSION
+    }
+
+
+def page_args(page: int, pagelen: int) -> (int, int):
+    """
+    Normalize paging arguments.
+
+    Args:
+        page (int): Page number or None for no paging.
+        pagelen (int): Documents per page or None for the default.
+    Returns:
+        (int, int): Page and page length, both None if not paging.
+    """
+    if page is None:
+        return (None, None)
+    return (max(int(page), 1), max(int(pagelen or PAGE_LENGTH), 1))
+
+
+def parse_query(query_text: str, code_list: str):
+    """
+    Convert the user's query to a Whoosh query.
+
+    Args:
+        query_text (str): Query string entered by user.
+        code_list (str): Space-delimited list of codes to search or '*' or '' for ALL.
+    Returns:
+        (str, whoosh.query.Query, tuple): Query text, parsed query, and
+        the sorted codes the search is limited to.
+    """
+    # Note the codes if user is narrowing the query to a subset of all
+    # indexed codes. They are applied as a filter, not as part of the query.
+    codes = parse_codes(code_list)
     if DEBUG:
         UTIL.logmessage(f"Query Text: {query_text}")
 
     # Convert query string to query-language query
-    query = parser.parse(query_text)
+    query = CODE_INDEX.parser.parse(query_text)
     if DEBUG:
         UTIL.logmessage(f"Query: {str(query)}")
+    return (query_text, query, codes)
+
 
-    # Search for results
-    documents = []
-    with index.searcher() as searcher:
-        result = searcher.search(query, terms=True)
-        result.fragmenter.charlimit = None
-        result.fragmenter.maxchars = 1000
-        result.fragmenter.surround = 50
-        for doc in result:
-            documents.append({
-                'code': doc.get('code', "NO CODE"),
-                'code_name': doc.get('code_name', "NO CODE NAME"),
-                'title': doc.get('title', "NO TITLE"),
-                'subtitle': doc.get('subtitle', "NO SUBTITLE"),
-                'chapter': doc.get('chapter', "NO CHAPTER"),
-                'subchapter': doc.get('subchapter', "NO SUBCHAPTER"),
-                'section_prefix': doc.get('section_prefix', 'Sec.'),
-                'section_number': doc.get('section_number', "NO SECTION NUMBER"),
-                'section_name': doc.get('section_name', "NO SECTION NAME"),
-                'text': doc.get('text', "NO TEXT"),
-                'source_text': doc.get('source_text', "NO SOURCE TEXT"),
-                'future_effective_date': doc.get('future_effective_date', "N/A"),
-                'highlights': doc.highlights('text'),
-                'filename': doc.get('filename'),
-                'version': VERSION
-            })
+def parse_codes(code_list: str) -> tuple:
+    """
+    Convert the user's code list to the codes a search is limited to.
+
+    Args:
+        code_list (str): Space-delimited list of codes to search or '*' or '' for ALL.
+    Returns:
+        (tuple): Sorted, upper-case code abbreviations. Empty for all codes.
+    """
+    if code_list == '*' or code_list == '':
+        return ()
+    codes = tuple(sorted(set(code_list.upper().split())))
+    if DEBUG:
+        UTIL.logmessage(f"Codes: {codes}")
+    return codes
+
+
+def run_query(searcher, query, page: int, pagelen: int, limit: int = 10, codes_filter=None, snapshot=None, codes: tuple = (),
+              groupedby: dict = None):
+    """
+    Run a query and set up highlighting for the hits. If a sharded snapshot
+    is given, only the shards for *codes* are searched, in parallel. The
+    search stops early if it runs out of time (see services.search_limits).
+
+    Args:
+        searcher (whoosh.searching.Searcher): Searcher to use.
+        query (whoosh.query.Query): Parsed query.
+        page (int): Page number or None for no paging.
+        pagelen (int): Documents per page.
+        limit (int): Most hits to return when not paging. None for all.
+        codes_filter: Filter from CODE_CATALOG.code_filter(), or None.
+        snapshot (Snapshot): Snapshot the searcher belongs to, for sharded searches.
+        codes (tuple): Codes to search, for sharded searches. Empty for all.
+        groupedby (dict): Facets from facet_groups(), or None.
+    Returns:
+        (iterable, whoosh.searching.Results, bool, dict): Hits to return, the
+        results they came from, True if the search ran out of time, and hit
+        counts for each facet (None if no facets were given).
+    """
+    # We don't ask Whoosh to record matched terms (terms=True): the highlighter
+    # works from the query terms instead, and the terms collector breaks
+    # the total count of filtered results.
+    groups = None
+    if snapshot is not None and snapshot.sharded:
+        hits, truncated, groups = shard_results(searcher, snapshot, query, page, pagelen, limit, codes, groupedby)
+        result = hits
+    elif page is None:
+        hits, truncated = collect(searcher, query, limit, codes_filter, groupedby=groupedby)
+        result = hits
+    else:
+        result, truncated = collect(searcher, query, page * pagelen, codes_filter, groupedby=groupedby)
+        hits = ResultsPage(result, page, pagelen)
+    if groupedby and groups is None:
+        groups = {name: result.groups(name) for name in groupedby}
+    result.fragmenter.charlimit = None
+    result.fragmenter.maxchars = 1000
+    result.fragmenter.surround = 50
+    return (hits, result, truncated, groups)
+
+
+def shard_results(searcher, snapshot, query, page: int, pagelen: int, limit: int, codes: tuple, groupedby: dict = None):
+    """
+    Search the shards for the requested codes in parallel and merge the hits.
+
+    Returns:
+        (whoosh.searching.Results, bool, dict): Merged hits for the requested
+        page, if any, True if a shard ran out of time, and merged facet
+        counts (None if no facets were given).
+    """
+    shards = snapshot.shards
+    if codes:
+        shards = [name for name in shards if name.upper() in codes]
+    if page is not None:
+        limit = page * pagelen
+    top_n, total, truncated, groups = search_shards(snapshot, query, shards, limit, groupedby)
+    if page is not None:
+        top_n = top_n[(page - 1) * pagelen:]
+    result = Results(searcher, query, top_n)
+    result._total = total
+    return (result, truncated, groups if groupedby else None)
+
+
+def summary(query_text: str, query, count: int, total: int, page: int, pagelen: int, truncated: bool = False) -> dict:
+    """
+    Build the part of a search response that describes the search. If the
+    search ran out of time, 'truncated' is set and the counts only cover
+    the documents found before it stopped.
+
+    Returns:
+        (dict): Query, counts, and paging information.
+    """
     result = {
         'query_text': query_text,
         'query': str(query),
-        'count': len(documents),
-        'documents': documents,
+        'count': count,
+        'total': total,
         'version': VERSION
     }
+    if page is not None:
+        result['page'] = page
+        result['pagelen'] = pagelen
+        result['pagecount'] = (total + pagelen - 1) // pagelen
+    if truncated:
+        result['truncated'] = True
     return result
 
 
+def no_hits(query_text: str, query, page: int, pagelen: int, facets: tuple) -> dict:
+    """
+    Build the response for a search that cannot match anything.
+    """
+    result = summary(query_text, query, 0, 0, page, pagelen)
+    if facets:
+        result['facets'] = {name: {} for name in facets}
+    result['documents'] = []
+    return result
+
+
+def get_document(code: str, section_number: str) -> dict:
+    """
+    Retrieve one section of a code in full.
+
+    Args:
+        code (str): Two-letter code abbreviation.
+        section_number (str): Section number, e.g. 153.009
+    Returns:
+        (dict): The document or None if there is no such section.
+    """
+    # Sections are looked up in the citation index, which keys them by the
+    # code as stored. The analyzed code field drops codes that are stop
+    # words, such as IN (the Insurance Code), so it cannot be searched.
+    citation = Citation(None, section_number.lower().strip(), None)
+    with CODE_INDEX.hold() as snapshot:
+        citations = CODE_CATALOG.citation_index(snapshot)
+        docnums = citations.lookup(citation, (code,)) if citations is not None else None
+        if not docnums:
+            return None
+        with CODE_INDEX.searcher(snapshot) as searcher:
+            hit = Results(searcher, NullQuery, [(None, docnums[0])])[0]
+            return document(hit, [f for f in FIELDS if f != 'highlights'], snapshot)
+
+
+def select_fields(fields: list) -> tuple:
+    """
+    Validate a field selection.
+
+    Args:
+        fields (list): Field names requested by the caller, or None for all fields.
+    Returns:
+        (tuple): Field names to return, in FIELDS order.
+    Raises:
+        ValueError: If a requested field does not exist.
+    """
+    if not fields:
+        return FIELDS
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))}")
+    return tuple(f for f in FIELDS if f in fields)
+
+
+def select_facets(facets: list) -> tuple:
+    """
+    Validate a facet selection.
+
+    Args:
+        facets (list): Facet names requested by the caller, or None for none.
+    Returns:
+        (tuple): Facet names, in FACETS order.
+    Raises:
+        ValueError: If a requested facet does not exist.
+    """
+    if not facets:
+        return ()
+    unknown = set(facets) - set(FACETS)
+    if unknown:
+        raise ValueError(f"Unknown facet(s): {', '.join(sorted(unknown))}")
+    return tuple(f for f in FACETS if f in facets)
+
+
+def facet_groups(searcher, facets: tuple) -> dict:
+    """
+    Build the Whoosh facets to count hits by. Fields with a sortable column
+    are read from the column; indexes built before the columns were added
+    fall back to the stored values, which is slower but gives the same counts.
+
+    Args:
+        searcher (whoosh.searching.Searcher): Searcher the facets will be used with.
+        facets (tuple): Facet names from select_facets().
+    Returns:
+        (dict): Facets keyed by name, or None if there are none.
+    """
+    if not facets:
+        return None
+    reader = searcher.reader()
+    return {
+        name: FieldFacet(name) if reader.has_column(name) else StoredFieldFacet(name)
+        for name in facets
+    }
+
+
+def facet_counts(searcher, groupedby: dict, docnums: list) -> dict:
+    """
+    Count documents found without a search, such as cited sections, by
+    facet. Keys are the same ones a faceted search of the documents gives.
+
+    Args:
+        searcher (whoosh.searching.Searcher): Searcher the documents belong to.
+        groupedby (dict): Facets from facet_groups().
+        docnums (list): Document numbers to count.
+    Returns:
+        (dict): Count for each value of each facet, keyed by facet name.
+    """
+    # Whoosh reads facet values one segment at a time.
+    leaves = searcher.leaf_searchers()
+    offsets = [offset for _, offset in leaves]
+    segments = {}
+    for docnum in docnums:
+        segments.setdefault(bisect_right(offsets, docnum) - 1, []).append(docnum)
+
+    groups = {}
+    for name, facet in groupedby.items():
+        categorizer = facet.categorizer(searcher)
+        counts = groups[name] = {}
+        for segment, segment_docnums in segments.items():
+            segment_searcher, offset = leaves[segment]
+            categorizer.set_searcher(segment_searcher, offset)
+            for docnum in segment_docnums:
+                key = categorizer.key_to_name(categorizer.key_for(None, docnum - offset))
+                counts[key] = counts.get(key, 0) + 1
+    return groups
+
+
+def document(hit, fields: tuple = FIELDS, snapshot=None) -> dict:
+    """
+    Convert a search hit to the document we return to our caller.
+
+    Args:
+        hit (whoosh.searching.Hit): Search hit.
+        fields (tuple): Fields to include. Highlights are only computed if requested.
+        snapshot (Snapshot): Snapshot the hit came from. Its document store
+                             holds the text and source text.
+    Returns:
+        (dict): Requested fields for this hit.
+    """
+    doc = {}
+    bodies = None
+    if BODY_FIELDS.intersection(fields):
+        bodies = (snapshot or CODE_INDEX.snapshot()).bodies(hit)
+    for field in fields:
+        if field == 'highlights':
+            doc[field] = hit.highlights('text', text=bodies.get('text', ''))
+        elif field in BODY_FIELDS:
+            doc[field] = bodies.get(field, FIELD_DEFAULTS.get(field))
+        elif field == 'version':
+            doc[field] = VERSION
+        else:
+            doc[field] = hit.get(field, FIELD_DEFAULTS.get(field))
+    return doc
+
+
 def download_index() -> bool:
-    # Instantiate AWS client to access S3 resources
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=os.environ.get('aws_access_key_id'),
-        aws_secret_access_key=os.environ.get('aws_secret_access_key')
-    )
+    """
+    Download the search index and code configurations from S3.
+
+    The index is unpacked into a new version directory and checked before
+    it is published, so searches never see a partly extracted index. Only
+    one download runs at a time.
+
+    Args:
+        None
+    Returns:
+        (bool): True if the index and code configurations are up to date.
+    """
+    if not DOWNLOAD_LOCK.acquire(blocking=False):
+        UTIL.logmessage("Index download already in progress")
+        return False
+
+    try:
+        return _download_index()
+    finally:
+        DOWNLOAD_LOCK.release()
+
+
+def _download_index() -> bool:
+    s3_client = S3.s3_client()
     s3_bucket_name = UTIL.get_env('S3_BUCKET_NAME', 'codesearch.attorney.bot')
+    manifest_file = os.path.join(FN.INDEX_PATH, 'downloads.json')
+    manifest = S3.load_manifest(manifest_file)
 
-    # List of archives we will download from S3
-    archives = [
-        {'object_name': 'index.zip', 'destination': FN.INDEX_PATH},
-        {'object_name': 'code_configs.zip', 'destination': FN.CODE_PATH}
-    ]
+    # We already have this index if it matches what we downloaded last time
+    # and that version is still being served.
+    index_info = manifest.get('index.zip')
+    if not os.path.exists(FN.CURRENT_FILE):
+        index_info = None
 
-    # Here to download and open the archives
-    for archive in archives:
-        destination = archive['destination']
-        object_name = archive['object_name']
+    # Download and unpack both archives at the same time. A new index
+    # version that is not published is removed, so it is never left behind
+    # to be counted as one of the versions we keep.
+    version = None
+    try:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            index_future = pool.submit(update_index, s3_client, s3_bucket_name, index_info)
+            configs_future = pool.submit(update_code_configs, s3_client, s3_bucket_name, manifest.get('code_configs.zip'))
+            version, index_info = index_future.result()
+            configs_changed, configs_info = configs_future.result()
+        if version is not None:
+            FN.publish_index_version(version)
+    except (NoCredentialsError, ClientError) as e:
+        UTIL.logmessage(f"Error downloading search index: {str(e)}")
+        discard_index_version(version)
+        return False
+    except Exception as e:
+        UTIL.logmessage(f"Error updating search index: {str(e)}")
+        discard_index_version(version)
+        return False
 
-        # Create destination path, if it does not exist
-        if not os.path.exists(destination):
-            os.mkdir(destination)
+    manifest['index.zip'] = index_info
+    manifest['code_configs.zip'] = configs_info
 
-        # Connect to S3 and download the archive to a binary file
-        try:
-            file_name = f'{destination}/{object_name}'
-            with open(file_name, 'wb') as fp:
-                s3_client.download_fileobj(s3_bucket_name, object_name, fp)
-        except NoCredentialsError as e:
-            print(str(e))
-            return False
-        except ClientError as e:
-            print(str(e))
-            return False
+    if version is not None:
+        FN.prune_index_versions(KEEP_VERSIONS)
+        UTIL.logmessage(f"Published index version {version}")
+    S3.save_manifest(manifest_file, manifest)
 
-        # Unpack the archive to its destination folder
+    # Pick up the new index
+    if version is not None or configs_changed:
         try:
-            shutil.unpack_archive(file_name, destination, 'zip')
+            CODE_INDEX.refresh(force=True)
         except Exception as e:
-            UTIL.logmessage(f"Error unzipping {file_name} to {destination}: {str(e)}")
+            UTIL.logmessage(f"Error opening downloaded index: {str(e)}")
             return False
 
     return True
+
+
+def discard_index_version(version: str):
+    """
+    Remove a downloaded index version that was not published.
+
+    Args:
+        version (str): Version name from update_index(), or None if there is none.
+    Returns:
+        None
+    """
+    if version is not None:
+        shutil.rmtree(os.path.join(FN.VERSIONS_PATH, version), ignore_errors=True)
+
+
+def update_index(s3_client, bucket: str, known: dict) -> (str, dict):
+    """
+    Download the index archive, if it has changed, into a new version directory.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        bucket (str): Bucket name.
+        known (dict): ETag and size of the index we are serving, or None.
+    Returns:
+        (str, dict): New version name, or None if the index is unchanged,
+        and the archive's ETag and size.
+    Raises:
+        ValueError: If the downloaded index is not usable.
+    """
+    buffer, info = S3.fetch(s3_client, bucket, 'index.zip', known)
+    if buffer is None:
+        return (None, info)
+
+    version, version_path = FN.new_index_version()
+    try:
+        try:
+            S3.extract(buffer, version_path)
+        finally:
+            buffer.close()
+
+        # Make sure the new index can be searched before we publish it.
+        if not validate_index(version_path):
+            raise ValueError("Downloaded index is not usable")
+    except Exception:
+        shutil.rmtree(version_path, ignore_errors=True)
+        raise
+    return (version, info)
+
+
+def update_code_configs(s3_client, bucket: str, known: dict) -> (bool, dict):
+    """
+    Download and unpack the code configurations if they have changed.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        bucket (str): Bucket name.
+        known (dict): ETag and size of the configurations we have, or None.
+    Returns:
+        (bool, dict): Whether they changed, and the archive's ETag and size.
+    """
+    buffer, info = S3.fetch(s3_client, bucket, 'code_configs.zip', known)
+    if buffer is None:
+        return (False, info)
+    try:
+        S3.extract(buffer, FN.CODE_PATH)
+    finally:
+        buffer.close()
+    return (True, info)
+
+
+def validate_index(index_path: str) -> bool:
+    """
+    Check that an index can be opened and has documents in it.
+
+    Args:
+        index_path (str): Directory holding the index.
+    Returns:
+        (bool): True if the index looks usable.
+    """
+    try:
+        doc_count = 0
+        for index in open_indexes(index_path).values():
+            doc_count += index.doc_count()
+    except Exception as e:
+        UTIL.logmessage(f"Index in {index_path} is not usable: {str(e)}")
+        return False
+    if doc_count == 0:
+        UTIL.logmessage(f"Index in {index_path} is empty")
+        return False
+    return True
+
+
+def refresh_index_in_background() -> bool:
+    """
+    Download and publish a new index on a background thread. Searches keep
+    running against the current index until the new one is ready.
+
+    Args:
+        None
+    Returns:
+        (bool): False if a download is already in progress.
+    """
+    if DOWNLOAD_LOCK.locked():
+        return False
+    thread = threading.Thread(target=download_index, name='index-refresh', daemon=True)
+    thread.start()
+    return True
+
+
+def start_index_refresher(minutes: int):
+    """
+    Start a background thread that downloads a new index every *minutes* minutes.
+
+    Args:
+        minutes (int): Minutes between downloads.
+    Returns:
+        None
+    """
+    def refresher():
+        while True:
+            time.sleep(minutes * 60)
+            try:
+                download_index()
+            except Exception as e:
+                UTIL.logmessage(f"Error refreshing index: {str(e)}")
+
+    thread = threading.Thread(target=refresher, name='index-refresher', daemon=True)
+    thread.start()
+    UTIL.logmessage(f"Refreshing search index every {minutes} minutes")
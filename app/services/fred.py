@@ -8,21 +8,33 @@ https://api.stlouisfed.org/fred/series/observations?series_id=MORTGAGE30US&api_k
 
 Copyright (c) 2019 by Thomas J. Daley. All Rights Reserved.
 """
+from datetime import date
 from decimal import Decimal
-import json
-import requests
 
+from services.fred_cache import FRED_CACHE
+from services.fred_store import AGGREGATIONS, FRED_STORE
+from services.single_flight import SingleFlight
+from services.upstream import upstream
 import util.util as UTIL
 
+FRED = upstream('FRED')
+FLIGHTS = SingleFlight('FRED')
+
 BASEURL = {}
-BASEURL["SERIES_SEARCH"] = "https://api.stlouisfed.org/fred/series/search?"
-BASEURL["SERIES_OBSERVATIONS"] = "https://api.stlouisfed.org/fred/series/observations?"
-BASEURL["CATEGORY"] = "https://api.stlouisfed.org/fred/category?"
-BASEURL["CATEGORY_CHILDREN"] = "https://api.stlouisfed.org/fred/category/children?"
-BASEURL["CATEGORY_SERIES"] = "https://api.stlouisfed.org/fred/category/series?"
+BASEURL["SERIES_SEARCH"] = FRED.url("series/search?")
+BASEURL["SERIES_OBSERVATIONS"] = FRED.url("series/observations?")
+BASEURL["CATEGORY"] = FRED.url("category?")
+BASEURL["CATEGORY_CHILDREN"] = FRED.url("category/children?")
+BASEURL["CATEGORY_SERIES"] = FRED.url("category/series?")
 
 SOURCE = "FRED"
 
+# Mortgage terms, in years, with an average rate series in FRED.
+MORTGAGE_TERMS = [5, 15, 30]
+
+# Most periods average_fixed_mortgages() will return for one term.
+MAX_PERIODS = 1200
+
 
 class Fred(object):
     """
@@ -42,6 +54,7 @@ class Fred(object):
         except ValueError as e:
             UTIL.logmessage(f"Unable to retrieve '{key}': {str(e)}")
             self.api_key = None
+        self.cache = FRED_CACHE
 
     def make_url(self, url_name: str, **params: dict) -> str:
         """
@@ -63,13 +76,15 @@ class Fred(object):
         """
         Retrieve data from FRED servers.
         """
-        response = requests.get(self.make_url(url_name, **params))
-        result = response.content.decode()
+        url = self.make_url(url_name, **params)
+        # Identical requests made at the same time share one upstream call.
+        result = FLIGHTS.do(url, lambda: FRED.get(url).content.decode())
         return result
 
     def series_observations(self, series_id: str, **kwargs):
         """
-        Get observations from a series.
+        Get observations from a series. Responses are cached in Redis (see
+        services.fred_cache).
 
         See: https://research.stlouisfed.org/docs/api/fred/series_observations.html
 
@@ -81,7 +96,7 @@ class Fred(object):
             The dataset requested.
         """
         kwargs["series_id"] = series_id.upper()
-        result = self.retrieve("SERIES_OBSERVATIONS", **kwargs)
+        result = self.cache.observations(kwargs, lambda: self.retrieve("SERIES_OBSERVATIONS", **kwargs))
         return result
 
     def category(self, category_id: int = 0, **kwargs):
@@ -89,32 +104,32 @@ class Fred(object):
         Get a category description.
         """
         kwargs["category_id"] = str(category_id)
-        url = self.make_url("CATEGORY", **kwargs)
-        print(url)
+        result = self.retrieve("CATEGORY", **kwargs)
+        return result
 
     def category_children(self, category_id: int = 0, **kwargs):
         """
         Get a list of child categories.
         """
         kwargs["category_id"] = str(category_id)
-        url = self.make_url("CATEGORY_CHILDREN", **kwargs)
-        print(url)
+        result = self.retrieve("CATEGORY_CHILDREN", **kwargs)
+        return result
 
     def category_series(self, category_id: int = 0, **kwargs):
         """
         Get a list of series for a category.
         """
         kwargs["category_id"] = str(category_id)
-        url = self.make_url("CATEGORY_SERIES", **kwargs)
-        print(url)
+        result = self.retrieve("CATEGORY_SERIES", **kwargs)
+        return result
 
     def series_search(self, search_text: str, **kwargs):
         """
         Get a list of series for a category.
         """
         kwargs["search_text"] = str(search_text)
-        url = self.make_url("SERIES_SEARCH", **kwargs)
-        print(url)
+        result = self.retrieve("SERIES_SEARCH", **kwargs)
+        return result
 
 
 class FredUtil(object):
@@ -124,6 +139,7 @@ class FredUtil(object):
 
     def __init__(self):
         self.fred = Fred()
+        self.store = FRED_STORE
 
     def average_fixed_mortgage(self, year: int, month: int = 0, duration: int = 30) -> Decimal:
         """
@@ -143,49 +159,135 @@ class FredUtil(object):
         i_month = int(month)
         i_duration = int(duration)
 
-        if i_duration not in [5, 15, 30]:
+        if i_duration not in MORTGAGE_TERMS:
             raise ValueError(f"duration must be one of 5, 15, or 30, not '{duration}''")
 
         if i_month < 0 or i_month > 12:
             raise ValueError(
                 "month must be in the range 1-12 (inclusive) or omitted, not '{month}'")
 
-        if i_month == 0:
-            observation_start = f"{year}-01-01"
-            observation_end = f"{year}-12-31"
-            frequency = "a"  # Annual
+        # Averages come from our local copy of the series, which only goes
+        # back to FRED for observations newer than the ones we have.
+        rate = self.store.average(f"MORTGAGE{i_duration}US", i_year, i_month)
+        return as_rate(rate)
+
+    def average_fixed_mortgages(self, start: str, end: str, durations: list = None, frequency: str = 'm') -> list:
+        """
+        Get the average mortgage interest rate for every month or year in a
+        range, for one or more loan terms. Each term's series is read once.
+
+        Args:
+            start (str): First period, as YYYY-MM, or YYYY for January.
+            end (str): Last period, as YYYY-MM, or YYYY for December.
+            durations (list): Terms of mortgage loans in years. [5, 15, 30]
+                              Defaults to all of them.
+            frequency (str): 'm' for monthly averages or 'a' for annual.
+
+        Returns:
+            (list): For each term, a dict with the 'term' and its 'rates',
+            a list of dicts with the 'year', 'month' (0 for annual), and
+            'rate' (None if FRED has no observations for the period).
+        """
+        if frequency not in ('m', 'a'):
+            raise ValueError(f"frequency must be 'm' or 'a', not '{frequency}'")
+        durations = [int(duration) for duration in (durations or MORTGAGE_TERMS)]
+        for duration in durations:
+            if duration not in MORTGAGE_TERMS:
+                raise ValueError(f"duration must be one of 5, 15, or 30, not '{duration}'")
+
+        first = parse_month(start, 1)
+        last = parse_month(end, 12)
+        if first > last:
+            raise ValueError(f"start '{start}' is after end '{end}'")
+        if frequency == 'a':
+            periods = [(year, 0) for year in range(first[0], last[0] + 1)]
         else:
-            # Figure out last day of the month, accounting for leap-years
-            # (during my lifetime)
-            last_day = [31, 28, 31, 30, 31, 30,
-                        31, 31, 30, 31, 30, 31][i_month - 1]
-            if i_year % 4 == 0 and i_month == 2:
-                last_day = 29
-
-            # FRED requires zero-padded values, e.g. "02" not "2"
-            padded_month = f"0{month}"[-2:]
-            padded_day = f"0{last_day}"[-2:]
-
-            # Construct start and end dates
-            observation_start = f"{year}-{padded_month}-01"
-            observation_end = f"{year}-{padded_month}-{padded_day}"
-            frequency = "m"  # Monthly
-
-        params = {
-            "observation_start": observation_start,
-            "observation_end": observation_end,
-            "frequency": frequency,
-            "aggregation_method": "avg",
-            "file_type": "json"
-        }
-
-        # Retrieve data.
-        result = self.fred.series_observations(
-            f"MORTGAGE{duration}US", **params)
-        result = json.loads(result)
-        rate = result["observations"][0]["value"]
-        rate = Decimal(Decimal(rate)/100)
-        return rate
+            periods = [
+                (year, month)
+                for year in range(first[0], last[0] + 1)
+                for month in range(1, 13)
+                if first <= (year, month) <= last
+            ]
+        if len(periods) > MAX_PERIODS:
+            raise ValueError(f"Too many periods ({len(periods)}). At most {MAX_PERIODS} may be requested.")
+
+        results = []
+        for duration in durations:
+            averages = self.store.series(f"MORTGAGE{duration}US").averages(frequency)
+            rates = [
+                {'year': year, 'month': month, 'rate': as_rate(averages.get((year, month)))}
+                for year, month in periods
+            ]
+            results.append({'term': duration, 'rates': rates})
+        return results
+
+    def observations(self, series_id: str, start: str = None, end: str = None, frequency: str = None,
+                     aggregation: str = 'avg') -> list:
+        """
+        Get observations of any series from our local copy of it.
+
+        Args:
+            series_id (str): FRED series ID, e.g. CPIAUCSL or DPRIME
+            start (str): First date, as YYYY-MM-DD. Defaults to the first observation.
+            end (str): Last date, as YYYY-MM-DD. Defaults to the last observation.
+            frequency (str): 'm', 'q', 'sa', or 'a' to aggregate by period,
+                             or None for the observations as published.
+            aggregation (str): 'avg', 'sum', or 'eop' (end of period).
+
+        Returns:
+            (list): A dict for each observation or period with its 'date' and
+            'value'. Averages have two more decimal places than the
+            observations. See services.fred_store.Series.observations().
+        """
+        first = parse_date(start)
+        last = parse_date(end)
+        if first and last and first > last:
+            raise ValueError(f"start '{start}' is after end '{end}'")
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"aggregation must be one of {', '.join(AGGREGATIONS)}, not '{aggregation}'")
+        return self.store.series(series_id).observations(first, last, frequency, aggregation)
+
+
+def parse_date(text: str) -> date:
+    """
+    Parse an optional date given as YYYY-MM-DD.
+    """
+    if not text:
+        return None
+    try:
+        return date.fromisoformat(str(text).strip())
+    except ValueError:
+        raise ValueError(f"Dates must be given as YYYY-MM-DD, not '{text}'")
+
+
+def parse_month(text: str, default_month: int) -> (int, int):
+    """
+    Parse a period given as YYYY-MM or YYYY.
+
+    Args:
+        text (str): Period to parse.
+        default_month (int): Month to use when only a year is given.
+    Returns:
+        (int, int): Year and month.
+    """
+    try:
+        year, _, month = str(text).strip().partition('-')
+        year = int(year)
+        month = int(month) if month else default_month
+    except ValueError:
+        raise ValueError(f"Periods must be given as YYYY-MM or YYYY, not '{text}'")
+    if month < 1 or month > 12:
+        raise ValueError(f"month must be in the range 1-12 (inclusive), not '{month}'")
+    return (year, month)
+
+
+def as_rate(value: float) -> Decimal:
+    """
+    Convert a percentage from FRED to a rate, e.g. 3.62 to 0.0362.
+    """
+    if value is None:
+        return None
+    return Decimal(Decimal(str(value))/100)
 
 
 if __name__ == "__main__":
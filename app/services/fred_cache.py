@@ -0,0 +1,213 @@
+"""
+fred_cache.py - Redis cache for FRED observation requests.
+
+Responses are keyed by series ID and the request parameters, sorted, so
+the same request always finds the same entry. A request whose period
+closed more than FRED_CACHE_CLOSE_DAYS ago can never get a different answer,
+so it is cached with no expiration. Anything that reaches into the current
+period, or has no end date, expires after FRED_CACHE_SECONDS so new weekly
+observations show up. Responses are stored as zlib-compressed JSON.
+
+Hit and miss counts are kept for this process and, in Redis, for every
+process sharing the cache.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from calendar import monthrange
+from datetime import date, timedelta
+import threading
+from urllib.parse import urlencode
+import zlib
+
+import redis
+
+import util.util as UTIL
+
+# Seconds to keep responses that may still change.
+CACHE_SECONDS = int(UTIL.get_env('FRED_CACHE_SECONDS', 60*60))
+
+# Days after a period ends before its observations are treated as final.
+# FRED publishes the last weekly observation of a month a few days later.
+CLOSE_DAYS = int(UTIL.get_env('FRED_CACHE_CLOSE_DAYS', 7))
+
+KEY_PREFIX = 'FRED-OBS'
+HITS_KEY = 'FRED-CACHE-HITS'
+MISSES_KEY = 'FRED-CACHE-MISSES'
+
+# Parameters that do not change the response.
+IGNORED_PARAMS = {'api_key'}
+
+
+class FredCache(object):
+    """
+    Caches FRED responses in Redis.
+    """
+
+    def __init__(self, redis_client=None):
+        """
+        Instance initializer.
+
+        Args:
+            redis_client (redis.Redis): Connection to use. Defaults to REDIS_HOST and REDIS_PORT.
+        """
+        self.redis = redis_client or UTIL.redis_connection()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def key(self, params: dict) -> str:
+        """
+        Build the cache key for a request.
+
+        Args:
+            params (dict): Request parameters, including series_id.
+        Returns:
+            (str): Cache key.
+        """
+        normalized = sorted((name, str(value)) for name, value in params.items() if name not in IGNORED_PARAMS)
+        return f'{KEY_PREFIX}-{params.get("series_id", "")}-{urlencode(normalized)}'
+
+    def ttl(self, params: dict, today: date = None) -> int:
+        """
+        Decide how long to keep a response.
+
+        Args:
+            params (dict): Request parameters.
+            today (date): Today's date. For testing.
+        Returns:
+            (int): Seconds to keep the response, or None to keep it forever.
+        """
+        end = params.get('observation_end')
+        if not end:
+            return CACHE_SECONDS
+        try:
+            end = date.fromisoformat(str(end))
+        except ValueError:
+            return CACHE_SECONDS
+        period_end = end_of_period(end, params.get('frequency', ''))
+        if period_end + timedelta(days=CLOSE_DAYS) < (today or date.today()):
+            return None
+        return CACHE_SECONDS
+
+    def observations(self, params: dict, fetch) -> str:
+        """
+        Get a response from the cache, or fetch and cache it.
+
+        Args:
+            params (dict): Request parameters, including series_id.
+            fetch (function): Called with no arguments to get the response
+                              from FRED on a miss.
+        Returns:
+            (str): Response content.
+        """
+        key = self.key(params)
+        content = self.get(key)
+        if content is not None:
+            self.count(HITS_KEY)
+            return content
+
+        self.count(MISSES_KEY)
+        content = fetch()
+        # FRED reports errors in the body. Only observations are cached.
+        if '"observations"' in content or '<observations' in content:
+            self.put(key, content, self.ttl(params))
+        return content
+
+    def get(self, key: str) -> str:
+        """
+        Read a response, or None if it is not cached or Redis is unavailable.
+        """
+        try:
+            value = self.redis.get(key)
+        except redis.exceptions.RedisError as e:
+            self.error(e)
+            return None
+        if value is None:
+            return None
+        return zlib.decompress(value).decode('utf-8')
+
+    def put(self, key: str, content: str, ttl: int):
+        """
+        Store a response, expiring after ttl seconds or never if ttl is None.
+        """
+        value = zlib.compress(content.encode('utf-8'))
+        try:
+            self.redis.set(key, value, ex=ttl)
+        except redis.exceptions.RedisError as e:
+            self.error(e)
+
+    def count(self, counter: str):
+        """
+        Count a hit or miss here and in Redis.
+        """
+        with self._lock:
+            if counter == HITS_KEY:
+                self.hits += 1
+            else:
+                self.misses += 1
+        try:
+            self.redis.incr(counter)
+        except redis.exceptions.RedisError as e:
+            self.error(e)
+
+    def error(self, e: Exception):
+        with self._lock:
+            self.errors += 1
+        UTIL.logmessage(f"FRED cache unavailable: {str(e)}")
+
+    def stats(self) -> dict:
+        """
+        Get cache statistics.
+
+        Returns:
+            (dict): Hit/miss counters for this process and for every process
+            sharing the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            result = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+        try:
+            hits, misses = (int(count or 0) for count in self.redis.mget(HITS_KEY, MISSES_KEY))
+        except redis.exceptions.RedisError as e:
+            self.error(e)
+            return result
+        lookups = hits + misses
+        result['shared'] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / lookups if lookups else 0.0,
+        }
+        return result
+
+
+def end_of_period(day: date, frequency: str) -> date:
+    """
+    Find the last day of the period an observation date falls in. Periods
+    shorter than a month are treated as ending with the month.
+
+    Args:
+        day (date): Observation date.
+        frequency (str): FRED frequency code, e.g. 'm', 'q', 'a', 'w'.
+    Returns:
+        (date): Last day of the period.
+    """
+    frequency = (frequency or '').lower()
+    if frequency == 'a':
+        month = 12
+    elif frequency == 'sa':
+        month = 6 if day.month <= 6 else 12
+    elif frequency == 'q':
+        month = (day.month + 2) // 3 * 3
+    else:
+        month = day.month
+    return date(day.year, month, monthrange(day.year, month)[1])
+
+
+# The one cache for this process.
+FRED_CACHE = FredCache()
@@ -0,0 +1,428 @@
+"""
+fred_store.py - Local copies of FRED time series.
+
+Each series is kept in FRED_STORE_PATH as three files:
+
+    <SERIES>.dates   Observation dates as date ordinals, one 32-bit int each
+    <SERIES>.values  Observation values as 64-bit floats, NaN where FRED has "."
+    <SERIES>.json    Series ID, number of observations, decimal places, and
+                     when we last asked FRED for new observations
+
+The arrays are memory-mapped read-only, so a series is read straight from
+the page cache and every worker process shares one copy of it. A series is
+refreshed when its last check is more than FRED_REFRESH_HOURS old: only
+observations after the last stored date are requested from FRED and
+appended to new copies of the files, which replace the old ones and are
+then mapped. Readers still holding the old mapping, in this process or
+another, keep a consistent view of the observations it covered.
+Date ranges are found by bisecting the dates, and monthly, quarterly,
+semiannual, and annual aggregates are computed from the arrays here
+instead of by FRED, so answering a request never waits on the network
+unless the series is stale.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+import fcntl
+import json
+import math
+import mmap
+import os
+import re
+import threading
+import time
+
+import util.util as UTIL
+
+STORE_PATH = UTIL.get_env('FRED_STORE_PATH', 'fred')
+
+# Hours between checks with FRED for new observations.
+REFRESH_HOURS = float(UTIL.get_env('FRED_REFRESH_HOURS', 12))
+
+DATE_TYPE = 'i'
+VALUE_TYPE = 'd'
+
+# Months in each aggregated period, keyed by FRED's frequency codes.
+FREQUENCIES = {'m': 1, 'q': 3, 'sa': 6, 'a': 12}
+
+# Ways of combining the observations in a period, as FRED names them:
+# average, sum, and end of period.
+AGGREGATIONS = ('avg', 'sum', 'eop')
+
+# Series IDs are also file names, so only these are accepted.
+SERIES_ID_PATTERN = re.compile(r'^[A-Z0-9_]{1,64}$')
+
+
+class Series(object):
+    """
+    Observations of one series, oldest first.
+    """
+
+    def __init__(self, series_id: str, dates: array, values: array, meta: dict):
+        """
+        Instance initializer.
+
+        Args:
+            series_id (str): FRED series ID, e.g. MORTGAGE30US
+            dates (memoryview): Date ordinals, ascending.
+            values (memoryview): Observation values, NaN where missing.
+            meta (dict): Contents of the series' metadata file.
+        """
+        self.series_id = series_id
+        self.dates = dates
+        self.values = values
+        self.meta = meta
+        self.decimals = meta.get('decimals', 2)
+        self._averages = {}
+        self._aggregates = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    @property
+    def last_date(self) -> date:
+        """
+        Date of the last observation, or None if there are none.
+        """
+        return date.fromordinal(self.dates[-1]) if len(self.dates) else None
+
+    def aggregate(self, frequency: str, aggregation: str = 'avg') -> (array, array):
+        """
+        Combine the observations in each period. Missing values are skipped,
+        as FRED does, and periods with no observations are left out. Averages
+        are rounded to two more decimal places than the observations have,
+        which keeps the digits FRED's own averages show without the error of
+        the float division; sums are rounded to the series' precision, which
+        is all the precision they can have.
+
+        Args:
+            frequency (str): 'm', 'q', 'sa', or 'a'.
+            aggregation (str): 'avg', 'sum', or 'eop' (the period's last observation).
+        Returns:
+            (array, array): Ordinal of the first day of each period, and its value.
+        """
+        aggregate = self._aggregates.get((frequency, aggregation))
+        if aggregate is not None:
+            return aggregate
+        if frequency not in FREQUENCIES:
+            raise ValueError(f"frequency must be one of {', '.join(FREQUENCIES)}, not '{frequency}'")
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"aggregation must be one of {', '.join(AGGREGATIONS)}, not '{aggregation}'")
+
+        # [start, total, count, last value] of each period, in date order.
+        periods = []
+        for ordinal, value in zip(self.dates, self.values):
+            if math.isnan(value):
+                continue
+            start = period_start(date.fromordinal(ordinal), frequency).toordinal()
+            if not periods or periods[-1][0] != start:
+                periods.append([start, 0.0, 0, value])
+            period = periods[-1]
+            period[1] += value
+            period[2] += 1
+            period[3] = value
+
+        starts = array(DATE_TYPE)
+        values = array(VALUE_TYPE)
+        for start, total, count, last in periods:
+            starts.append(start)
+            if aggregation == 'avg':
+                values.append(round(total / count, self.decimals + 2))
+            elif aggregation == 'sum':
+                values.append(round(total, self.decimals))
+            else:
+                values.append(last)
+        aggregate = (starts, values)
+        self._aggregates[(frequency, aggregation)] = aggregate
+        return aggregate
+
+    def averages(self, frequency: str) -> dict:
+        """
+        Average the observations in each month or year.
+
+        Args:
+            frequency (str): 'm' for monthly or 'a' for annual.
+        Returns:
+            (dict): Average keyed by (year, month), month 0 for annual.
+        """
+        averages = self._averages.get(frequency)
+        if averages is not None:
+            return averages
+        if frequency not in ('m', 'a'):
+            raise ValueError(f"frequency must be 'm' or 'a', not '{frequency}'")
+
+        averages = {}
+        for ordinal, value in zip(*self.aggregate(frequency, 'avg')):
+            day = date.fromordinal(ordinal)
+            averages[(day.year, day.month if frequency == 'm' else 0)] = value
+        self._averages[frequency] = averages
+        return averages
+
+    def observations(self, start: date = None, end: date = None, frequency: str = None,
+                     aggregation: str = 'avg') -> list:
+        """
+        Get the observations in a date range, as stored or aggregated by period.
+
+        Args:
+            start (date): First date. Aggregated periods are included if any
+                          part of them is in the range. Defaults to the first
+                          observation.
+            end (date): Last date. Defaults to the last observation.
+            frequency (str): 'm', 'q', 'sa', or 'a' to aggregate by period,
+                             or None for the observations as stored.
+            aggregation (str): 'avg', 'sum', or 'eop'. See aggregate().
+        Returns:
+            (list): A dict for each observation or period with its 'date'
+            (the first day of the period, when aggregated) and 'value' (None
+            where FRED has no value).
+        """
+        if frequency:
+            dates, values = self.aggregate(frequency, aggregation)
+            if start is not None:
+                start = period_start(start, frequency)
+        else:
+            dates, values = (self.dates, self.values)
+        first = bisect_left(dates, start.toordinal()) if start is not None else 0
+        last = bisect_right(dates, end.toordinal()) if end is not None else len(dates)
+        return [
+            {
+                'date': date.fromordinal(dates[i]).isoformat(),
+                'value': None if math.isnan(values[i]) else values[i],
+            }
+            for i in range(first, last)
+        ]
+
+    def average(self, year: int, month: int = 0) -> float:
+        """
+        Get the average for a month, or for a year if month is 0.
+
+        Returns:
+            (float): Average, or None if there are no observations for the period.
+        """
+        return self.averages('a' if month == 0 else 'm').get((year, month))
+
+
+class FredStore(object):
+    """
+    Local store of FRED series, refreshed incrementally from FRED.
+    """
+
+    def __init__(self, path: str = STORE_PATH, fred=None):
+        """
+        Instance initializer.
+
+        Args:
+            path (str): Directory holding the series files.
+            fred (services.fred.Fred): Client used to fetch observations.
+                                       Created when first needed.
+        """
+        self.path = path
+        self._fred = fred
+        self._series = {}
+        self._lock = threading.Lock()
+
+    @property
+    def fred(self):
+        if self._fred is None:
+            # Imported here because services.fred uses this module.
+            from services.fred import Fred
+            self._fred = Fred()
+        return self._fred
+
+    def series(self, series_id: str) -> Series:
+        """
+        Get a series, loading it from disk and refreshing it from FRED if needed.
+        If FRED cannot be reached, the observations we already have are used.
+
+        Args:
+            series_id (str): FRED series ID, e.g. MORTGAGE30US
+        Returns:
+            (Series): The series.
+        Raises:
+            ValueError: If the series ID is not valid, or if we have no
+                        observations and FRED has none either.
+        """
+        series_id = series_id.upper()
+        if not SERIES_ID_PATTERN.match(series_id):
+            raise ValueError(f"Not a valid series ID: '{series_id}'")
+        series = self._series.get(series_id)
+        if series is not None and not self.is_stale(series):
+            return series
+
+        with self._lock:
+            series = self._series.get(series_id)
+            if series is None:
+                series = self.load(series_id)
+            if self.is_stale(series):
+                try:
+                    series = self.refresh(series)
+                except Exception as e:
+                    if not len(series):
+                        raise ValueError(f"No observations for {series_id}: {str(e)}")
+                    UTIL.logmessage(f"Unable to refresh {series_id}, using stored observations: {str(e)}")
+                    # Try again after another refresh interval.
+                    series.meta['checked'] = time.time()
+            self._series[series_id] = series
+        return series
+
+    def is_stale(self, series: Series) -> bool:
+        """
+        See if it is time to ask FRED for new observations.
+        """
+        return time.time() - series.meta.get('checked', 0) > REFRESH_HOURS * 3600
+
+    def file_name(self, series_id: str, extension: str) -> str:
+        return os.path.join(self.path, f'{series_id}.{extension}')
+
+    def load(self, series_id: str) -> Series:
+        """
+        Read a series from disk. A series we have never stored is empty.
+
+        Args:
+            series_id (str): FRED series ID.
+        Returns:
+            (Series): The stored observations.
+        """
+        meta = {'series_id': series_id, 'count': 0}
+        if os.path.exists(self.file_name(series_id, 'json')):
+            with open(self.file_name(series_id, 'json'), 'r') as fp:
+                meta = json.load(fp)
+
+        # The metadata is written last, so it never counts observations
+        # that did not make it to both arrays.
+        count = meta['count']
+        dates = map_array(self.file_name(series_id, 'dates'), DATE_TYPE, count)
+        values = map_array(self.file_name(series_id, 'values'), VALUE_TYPE, count)
+        meta['count'] = min(len(dates), len(values))
+        return Series(series_id, dates[:meta['count']], values[:meta['count']], meta)
+
+    def refresh(self, series: Series) -> Series:
+        """
+        Fetch the observations after the last one we have and append them.
+
+        Args:
+            series (Series): Series as stored.
+        Returns:
+            (Series): Series with the new observations.
+        """
+        params = {'file_type': 'json'}
+        if series.last_date is not None:
+            params['observation_start'] = (series.last_date + timedelta(days=1)).isoformat()
+        result = json.loads(self.fred.series_observations(series.series_id, **params))
+        if 'observations' not in result:
+            raise ValueError(result.get('error_message', "FRED returned no observations"))
+
+        dates = array(DATE_TYPE)
+        values = array(VALUE_TYPE)
+        decimals = series.meta.get('decimals', 0)
+        last = series.dates[-1] if len(series) else 0
+        for observation in result['observations']:
+            ordinal = date.fromisoformat(observation['date']).toordinal()
+            if ordinal <= last:
+                continue
+            dates.append(ordinal)
+            values.append(parse_value(observation['value']))
+            decimals = max(decimals, decimal_places(observation['value']))
+            last = ordinal
+
+        meta = dict(series.meta)
+        meta['count'] = len(series) + len(dates)
+        meta['decimals'] = decimals
+        meta['checked'] = time.time()
+        self.append(series.series_id, dates, values, meta)
+        if dates:
+            UTIL.logmessage(f"Added {len(dates)} observations to {series.series_id}")
+        return self.load(series.series_id)
+
+    def append(self, series_id: str, dates: array, values: array, meta: dict):
+        """
+        Append observations to a series' files and replace its metadata.
+
+        Each file is copied, with the new observations added, and the copy
+        replaces it. A file that is mapped, possibly by another process, is
+        never changed in place, because truncating it under a mapping would
+        crash the reader. A lock file keeps processes refreshing the same
+        series from writing at the same time.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.file_name(series_id, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for extension, data in (('dates', dates), ('values', values)):
+                file_name = self.file_name(series_id, extension)
+                # Drop anything past the last observation the metadata counted.
+                keep = data.itemsize * (meta['count'] - len(data))
+                temp_name = f'{file_name}.tmp'
+                with open(temp_name, 'wb') as fp:
+                    if keep:
+                        with open(file_name, 'rb') as old:
+                            fp.write(old.read(keep))
+                    data.tofile(fp)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(temp_name, file_name)
+            temp_name = self.file_name(series_id, 'json.tmp')
+            with open(temp_name, 'w') as fp:
+                json.dump(meta, fp)
+            os.replace(temp_name, self.file_name(series_id, 'json'))
+
+    def average(self, series_id: str, year: int, month: int = 0) -> float:
+        """
+        Get the average of a series for a month, or for a year if month is 0.
+
+        Returns:
+            (float): Average, or None if there are no observations for the period.
+        """
+        return self.series(series_id).average(year, month)
+
+
+def map_array(file_name: str, typecode: str, count: int) -> memoryview:
+    """
+    Memory-map up to count items of an array file, read-only. A missing or
+    empty file is empty. The map stays open for as long as the view, or any
+    slice of it, is referenced.
+    """
+    itemsize = array(typecode).itemsize
+    if not os.path.exists(file_name) or os.path.getsize(file_name) < itemsize:
+        return memoryview(array(typecode))
+    with open(file_name, 'rb') as fp:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    usable = min(count, len(mapped) // itemsize) * itemsize
+    return memoryview(mapped)[:usable].cast(typecode)
+
+
+def period_start(day: date, frequency: str) -> date:
+    """
+    Find the first day of the period a date falls in.
+
+    Args:
+        day (date): Any date.
+        frequency (str): 'm', 'q', 'sa', or 'a'.
+    Returns:
+        (date): First day of the period.
+    """
+    months = FREQUENCIES[frequency]
+    return date(day.year, (day.month - 1) // months * months + 1, 1)
+
+
+def parse_value(value: str) -> float:
+    """
+    Convert an observation value. FRED uses "." for a missing value.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+def decimal_places(value: str) -> int:
+    """
+    Count the digits after the decimal point in an observation value.
+    """
+    whole, point, fraction = value.partition('.')
+    return len(fraction) if point and whole else 0
+
+
+# The one store for this process.
+FRED_STORE = FredStore()
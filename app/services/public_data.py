@@ -8,19 +8,22 @@ Copyright (c) 2020 by Thomas J. Daley, J.D. Licensed under BSD License.
 from datetime import datetime
 import os
 import redis
-import requests
 import xml.etree.ElementTree as ET
 import xml
 
+from services.upstream import upstream
 import util.util as UTIL
 
-SEARCH_URL = 'http://lbsearch.publicdata.com/pdsearch.php'
+PUBLIC_DATA = upstream('PUBLIC_DATA')
+PUBLIC_DATA_LOGIN = upstream('PUBLIC_DATA_LOGIN')
+
+SEARCH_URL = PUBLIC_DATA.url('pdsearch.php')
 TAX_SEARCH_PARTS = [
     'p1={street} {city}',
     'matchany=all',
-    'input=grp_cad_{state.lower()}_advanced_main',
+    'input=grp_cad_{state}_advanced_main',
     'type=advanced',
-    'dlnumber={api_key}'
+    'dlnumber={api_key}',
     'dlstate=UID',
     'id=',
     'identifier=',
@@ -30,7 +33,7 @@ TAX_SEARCH_PARTS = [
 ]
 TAX_SEARCH_URL = '{}?{}'.format(SEARCH_URL, '&'.join(TAX_SEARCH_PARTS))
 
-DETAILS_URL = 'http://lbsearch.publicdata.com/pddetails.php'
+DETAILS_URL = PUBLIC_DATA.url('pddetails.php')
 PROP_DETAILS_PARTS = [
     'db={db}',
     'rec={rec}',
@@ -44,7 +47,7 @@ PROP_DETAILS_PARTS = [
 ]
 PROP_DETAILS_URL = '{}?{}'.format(DETAILS_URL, '&'.join(PROP_DETAILS_PARTS))
 
-LOGIN_URL = 'https://login.publicdata.com/pdmain.php/logon/checkAccess?disp=XML&login_id={api_key}&password={password}'
+LOGIN_URL = PUBLIC_DATA_LOGIN.url('pdmain.php/logon/checkAccess?disp=XML&login_id={api_key}&password={password}')
 
 SOURCE = "PUBLICDATA"
 
@@ -98,18 +101,19 @@ class PDTaxRecords(object):
 
         # Here to perform a login because we have no day key for today's date.
         url = LOGIN_URL.format(api_key=self.api_key, password=self.api_password)
-        tree = self.load_xml(url)
+        tree = self.load_xml(url, PUBLIC_DATA_LOGIN)
 
         session_key = session_key(tree)
         self.redis.setex(key, 60*60*24, session_key)
         return session_key
 
-    def load_xml(self, url: str) -> (bool, str, object):
+    def load_xml(self, url: str, client=PUBLIC_DATA) -> (bool, str, object):
         """
         Load XML from a URL.
 
         Args:
             url (str): URL to load from.
+            client (Upstream): Upstream the URL belongs to.
 
         Returns:
             (bool, str, object): The *bool* indicates success or failure.
@@ -118,7 +122,7 @@ class PDTaxRecords(object):
         """
         try:
             # Retrieve response from server
-            response = requests.get(url, allow_redirects=False)
+            response = client.get(url, allow_redirects=False)
 
             # Convert response from stream of bytes to string
             content = response.content.decode()
@@ -210,7 +214,7 @@ class PDTaxRecords(object):
             url = TAX_SEARCH_URL.format(
                 street=street_address,
                 city=city,
-                state=state,
+                state=state.lower(),
                 api_key=self.api_key,
                 session_id=session_id
             )
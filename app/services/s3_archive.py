@@ -0,0 +1,176 @@
+"""
+s3_archive.py - Download zip archives from S3 and unpack them.
+
+Archives are skipped when their ETag and size match the copy we already
+have. Otherwise they are fetched with parallel ranged GETs into an anonymous
+memory map and unpacked straight from memory, without writing the archive
+to disk first.
+
+Set S3_ENDPOINT_URL to use a local S3 stand-in such as MinIO.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import mmap
+import os
+import zipfile
+
+import boto3
+
+import util.util as UTIL
+
+CHUNK_SIZE = int(UTIL.get_env('S3_CHUNK_MB', 8)) * 1024 * 1024
+MAX_WORKERS = int(UTIL.get_env('S3_MAX_WORKERS', 8))
+
+
+class MemoryFile(io.RawIOBase):
+    """
+    Read-only, seekable file over a buffer, so zipfile can read an archive
+    held in memory without copying it.
+    """
+
+    def __init__(self, buffer):
+        """
+        Instance initializer.
+
+        Args:
+            buffer: Any object supporting the buffer protocol, e.g. mmap.
+        """
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(offset, 0)
+        return self._position
+
+    def readinto(self, b) -> int:
+        chunk = self._view[self._position:self._position + len(b)]
+        b[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+def s3_client():
+    """
+    Create an S3 client from our configuration.
+
+    Returns:
+        (boto3.client): S3 client.
+    """
+    return boto3.client(
+        's3',
+        endpoint_url=UTIL.get_env('S3_ENDPOINT_URL'),
+        aws_access_key_id=os.environ.get('aws_access_key_id'),
+        aws_secret_access_key=os.environ.get('aws_secret_access_key')
+    )
+
+
+def fetch(client, bucket: str, object_name: str, known: dict = None) -> (mmap.mmap, dict):
+    """
+    Download an object unless it matches the copy we already have.
+
+    Args:
+        client (boto3.client): S3 client.
+        bucket (str): Bucket name.
+        object_name (str): Key of the object to download.
+        known (dict): ETag and size of our copy, from a previous fetch, or None.
+    Returns:
+        (mmap.mmap, dict): Object contents, or None if unchanged, and the
+        object's ETag and size. The caller must close the mmap.
+    """
+    head = client.head_object(Bucket=bucket, Key=object_name)
+    info = {'etag': head['ETag'], 'size': head['ContentLength']}
+    if known and known.get('etag') == info['etag'] and known.get('size') == info['size']:
+        UTIL.logmessage(f"{object_name} is unchanged")
+        return (None, info)
+
+    size = info['size']
+    buffer = mmap.mmap(-1, max(size, 1))
+
+    def fetch_range(start: int):
+        end = min(start + CHUNK_SIZE, size) - 1
+        response = client.get_object(Bucket=bucket, Key=object_name, Range=f'bytes={start}-{end}', IfMatch=info['etag'])
+        body = response['Body']
+        position = start
+        for chunk in body.iter_chunks(1024 * 1024):
+            buffer[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        if position != end + 1:
+            raise IOError(f"Short read of {object_name} at bytes {start}-{end}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            list(pool.map(fetch_range, range(0, size, CHUNK_SIZE)))
+    except Exception:
+        buffer.close()
+        raise
+
+    UTIL.logmessage(f"Downloaded {object_name} ({size} bytes)")
+    return (buffer, info)
+
+
+def extract(buffer: mmap.mmap, destination: str):
+    """
+    Unpack a zip archive held in memory.
+
+    Args:
+        buffer (mmap.mmap): Archive contents from fetch().
+        destination (str): Directory to unpack into.
+    Returns:
+        None
+    """
+    if not os.path.exists(destination):
+        os.makedirs(destination)
+    with MemoryFile(buffer) as fp, zipfile.ZipFile(fp) as archive:
+        archive.extractall(destination)
+
+
+def load_manifest(path: str) -> dict:
+    """
+    Load the ETags and sizes of the archives we downloaded last time.
+
+    Args:
+        path (str): Manifest file.
+    Returns:
+        (dict): Object info keyed by object name.
+    """
+    try:
+        with open(path, 'r') as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_manifest(path: str, manifest: dict):
+    """
+    Save the ETags and sizes of the archives we have downloaded.
+
+    Args:
+        path (str): Manifest file.
+        manifest (dict): Object info keyed by object name.
+    Returns:
+        None
+    """
+    temp_file = f'{path}.{os.getpid()}'
+    with open(temp_file, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(temp_file, path)
@@ -0,0 +1,148 @@
+"""
+search_limits.py - Keep one expensive query from tying up a worker.
+
+Fuzzy terms (child~2) are limited in how far they reach and how many index
+terms they expand to, and every search runs against a time budget. A search
+that runs out of time returns the hits collected so far, flagged as
+truncated.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import heapq
+import time
+
+from whoosh.collectors import FacetCollector, FilterCollector, TimeLimit, TimeLimitCollector, TopCollector, UnlimitedCollector
+from whoosh.qparser import FuzzyTermPlugin
+from whoosh.query import FuzzyTerm
+from whoosh.sorting import Count
+
+import util.util as UTIL
+
+# Largest edit distance a fuzzy term may use, whatever the user types.
+FUZZY_MAX_DISTANCE = int(UTIL.get_env('FUZZY_MAX_DISTANCE', 2))
+
+# Leading characters a fuzzy match must share with the term.
+FUZZY_PREFIX_LENGTH = int(UTIL.get_env('FUZZY_PREFIX_LENGTH', 1))
+
+# Most index terms one fuzzy term expands to. The most frequent are kept.
+FUZZY_MAX_TERMS = int(UTIL.get_env('FUZZY_MAX_TERMS', 50))
+
+# Seconds a search may spend collecting hits. Zero for no limit.
+SEARCH_TIME_LIMIT = float(UTIL.get_env('SEARCH_TIME_LIMIT', 2.0))
+
+# How many hits are collected between looks at the clock.
+CLOCK_INTERVAL = 64
+
+
+class BoundedFuzzyTerm(FuzzyTerm):
+    """
+    FuzzyTerm whose edit distance, prefix, and expansion are capped by our
+    configuration.
+    """
+
+    def _btexts(self, ixreader):
+        maxdist = min(self.maxdist, FUZZY_MAX_DISTANCE)
+        prefix = max(self.prefixlength, FUZZY_PREFIX_LENGTH)
+        words = list(ixreader.terms_within(self.fieldname, self.text, maxdist, prefix=prefix))
+        if len(words) <= FUZZY_MAX_TERMS:
+            return words
+        return heapq.nlargest(FUZZY_MAX_TERMS, words, key=lambda word: ixreader.doc_frequency(self.fieldname, word))
+
+
+class BoundedFuzzyTermPlugin(FuzzyTermPlugin):
+    """
+    FuzzyTermPlugin that creates BoundedFuzzyTerm queries.
+    """
+
+    class FuzzyTermNode(FuzzyTermPlugin.FuzzyTermNode):
+        qclass = BoundedFuzzyTerm
+
+
+class DeadlineCollector(TimeLimitCollector):
+    """
+    TimeLimitCollector that looks at the clock while it walks the matches.
+    Whoosh's version starts a timer thread per search and can only stop a
+    search with SIGALRM on the main thread, which we are never on.
+
+    Put this collector under any FilterCollector, so the clock is checked
+    for every match, not just the documents the filter lets through.
+    """
+
+    def __init__(self, child, timelimit: float):
+        TimeLimitCollector.__init__(self, child, timelimit, use_alarm=False)
+        self.deadline = None
+        self.collected = 0
+
+    def prepare(self, top_searcher, q, context):
+        # The clock starts before the matchers are built, so expanding the
+        # query counts against the budget.
+        self.child.prepare(top_searcher, q, context)
+        self.timedout = False
+        self.collected = 0
+        self.deadline = time.monotonic() + self.timelimit
+
+    def matches(self):
+        deadline = self.deadline
+        for count, sub_docnum in enumerate(self.child.matches()):
+            if count % CLOCK_INTERVAL == 0 and time.monotonic() > deadline:
+                self.timedout = True
+                raise TimeLimit
+            yield sub_docnum
+
+    def collect_matches(self):
+        for sub_docnum in self.matches():
+            self.collect(sub_docnum)
+
+    def computes_count(self):
+        return self.child.computes_count()
+
+    def collect(self, sub_docnum):
+        self.collected += 1
+        return self.child.collect(sub_docnum)
+
+    def finish(self):
+        self.child.finish()
+
+
+def collect(searcher, query, limit: int = 10, filter=None, timelimit: float = None, groupedby: dict = None):
+    """
+    Run a search within a time budget.
+
+    Args:
+        searcher (whoosh.searching.Searcher): Searcher to use.
+        query (whoosh.query.Query): Parsed query.
+        limit (int): Most hits to return. None for all.
+        filter: Allowed documents, as accepted by Searcher.search().
+        timelimit (float): Seconds allowed. Defaults to SEARCH_TIME_LIMIT.
+        groupedby (dict): Whoosh facets keyed by name, to count hits by
+                          in the same pass. See Results.groups().
+    Returns:
+        (whoosh.searching.Results, bool): Results, and True if the search
+        ran out of time and the results are incomplete.
+    """
+    if timelimit is None:
+        timelimit = SEARCH_TIME_LIMIT
+    if groupedby:
+        # Every match has to be counted, so there are no blocks to skip
+        # (usequality) and no switching to a matcher that skips documents
+        # scoring below the current top hits (replace).
+        if limit:
+            collector = TopCollector(limit=limit, usequality=False, replace=0)
+        else:
+            collector = UnlimitedCollector()
+        collector = deadline = FacetCollector(collector, groupedby, maptype=Count)
+    else:
+        collector = deadline = searcher.collector(limit=limit)
+    if timelimit:
+        collector = deadline = DeadlineCollector(collector, timelimit)
+    if filter is not None:
+        collector = FilterCollector(collector, allow=filter)
+    try:
+        searcher.search_with_collector(query, collector)
+    except TimeLimit:
+        UTIL.logmessage(f"Search ran out of time after {timelimit}s: {query}")
+        # Counting every match would mean running the rest of the search
+        results = collector.results()
+        results._total = deadline.collected
+        return (results, True)
+    return (collector.results(), False)
@@ -0,0 +1,181 @@
+"""
+single_flight.py - Coalesce identical upstream calls made at the same time.
+
+When several requests need the same upstream response at once, only the
+first one fetches it; the rest wait for that response instead of sending
+their own request. Within a process, waiters share the leader's result,
+or its exception, directly. Across worker processes, the leader holds a
+Redis lock for the key while it fetches and leaves the response under a
+result key for a few seconds; other workers wait for the result key
+instead of fetching. If Redis is unavailable, or the leader gives up
+without a result, the waiter fetches for itself.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import hashlib
+import threading
+import time
+import uuid
+import zlib
+
+import redis
+
+import util.util as UTIL
+
+# Seconds a worker may hold the lock for a key. Longer than any upstream
+# call should take, so the lock outlives its fetch.
+LOCK_SECONDS = float(UTIL.get_env('SINGLE_FLIGHT_LOCK_SECONDS', 60))
+
+# Seconds the result of a fetch stays available to workers waiting for it.
+RESULT_SECONDS = float(UTIL.get_env('SINGLE_FLIGHT_RESULT_SECONDS', 10))
+
+# Seconds a waiter waits for another fetch before fetching for itself.
+WAIT_SECONDS = float(UTIL.get_env('SINGLE_FLIGHT_WAIT_SECONDS', 30))
+
+# Seconds between looks at the result key while another worker fetches.
+POLL_SECONDS = 0.05
+
+# Deletes the lock only if we still hold it.
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class Flight(object):
+    """
+    One fetch in progress in this process.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs at most one fetch per key at a time, in this process and, through
+    Redis, across processes.
+    """
+
+    def __init__(self, name: str, redis_client=None):
+        """
+        Instance initializer.
+
+        Args:
+            name (str): Prefix for this group's Redis keys, e.g. FRED.
+            redis_client (redis.Redis): Connection to use. Defaults to REDIS_HOST and REDIS_PORT.
+        """
+        self.name = name
+        self.redis = redis_client or UTIL.redis_connection()
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fetch) -> str:
+        """
+        Get the response for a key, sharing any fetch already in progress.
+
+        Args:
+            key (str): Identifies the call, e.g. its URL.
+            fetch (function): Called with no arguments to get the response.
+        Returns:
+            (str): Response.
+        Raises:
+            Whatever fetch raises, for the leader and every waiter in this process.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self._flights[key] = flight
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.done.wait(WAIT_SECONDS):
+                return fetch()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self.shared(key, fetch)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def shared(self, key: str, fetch) -> str:
+        """
+        Fetch a response, or wait for another worker that is fetching it.
+
+        Args:
+            key (str): Identifies the call.
+            fetch (function): Called with no arguments to get the response.
+        Returns:
+            (str): Response.
+        """
+        # Keys can hold API keys, so Redis only sees a digest of them.
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        lock_key = f'{self.name}-FLIGHT-LOCK-{digest}'
+        result_key = f'{self.name}-FLIGHT-RESULT-{digest}'
+        token = uuid.uuid4().hex
+
+        try:
+            locked = self.redis.set(lock_key, token, nx=True, px=int(LOCK_SECONDS * 1000))
+        except redis.exceptions.RedisError as e:
+            UTIL.logmessage(f"Single flight unavailable for {self.name}: {str(e)}")
+            return fetch()
+
+        if not locked:
+            result = self.wait(lock_key, result_key)
+            if result is not None:
+                with self._lock:
+                    self.coalesced += 1
+                return result
+            return fetch()
+
+        try:
+            result = fetch()
+            try:
+                self.redis.set(result_key, zlib.compress(result.encode('utf-8')), px=int(RESULT_SECONDS * 1000))
+            except redis.exceptions.RedisError as e:
+                UTIL.logmessage(f"Unable to share {self.name} result: {str(e)}")
+            return result
+        finally:
+            try:
+                self.redis.eval(RELEASE_SCRIPT, 1, lock_key, token)
+            except redis.exceptions.RedisError as e:
+                UTIL.logmessage(f"Unable to release {self.name} lock: {str(e)}")
+
+    def wait(self, lock_key: str, result_key: str) -> str:
+        """
+        Wait for another worker's result.
+
+        Returns:
+            (str): Result, or None if the other worker finished without one
+            or did not finish in time.
+        """
+        deadline = time.monotonic() + WAIT_SECONDS
+        try:
+            while time.monotonic() < deadline:
+                value = self.redis.get(result_key)
+                if value is not None:
+                    return zlib.decompress(value).decode('utf-8')
+                if not self.redis.exists(lock_key):
+                    # Finished without a result, or finished just now.
+                    value = self.redis.get(result_key)
+                    return zlib.decompress(value).decode('utf-8') if value is not None else None
+                time.sleep(POLL_SECONDS)
+        except redis.exceptions.RedisError as e:
+            UTIL.logmessage(f"Single flight unavailable for {self.name}: {str(e)}")
+        return None
@@ -0,0 +1,168 @@
+"""
+suggest_index.py - Typeahead suggestions from the index vocabulary and
+section names.
+
+The SuggestIndex for a generation of the search index is built by the code
+catalog when the index is loaded. Words and section names are kept in
+sorted lists, so the candidates for a prefix are one bisect away. The best
+candidates for short prefixes, which match the most entries, are ranked
+ahead of time.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from bisect import bisect_left
+import heapq
+
+# Prefixes up to this length have their best entries ranked ahead of time.
+RANKED_PREFIX_LENGTH = 3
+
+# Most entries kept for each ranked prefix.
+RANKED_COUNT = 50
+
+# Sorts after any character that can follow a prefix.
+HIGHEST = '\U0010ffff'
+
+
+class PrefixList(object):
+    """
+    Sorted keys with counts, searchable by prefix.
+    """
+
+    def __init__(self, counts: dict):
+        """
+        Instance initializer.
+
+        Args:
+            counts (dict): Count for each lower-case key.
+        """
+        self.keys = sorted(counts)
+        self.counts = [counts[key] for key in self.keys]
+        buckets = {}
+        for position, key in enumerate(self.keys):
+            for length in range(1, min(len(key), RANKED_PREFIX_LENGTH) + 1):
+                buckets.setdefault(key[:length], []).append(position)
+        self.ranked = {
+            prefix: heapq.nlargest(RANKED_COUNT, positions, key=self.counts.__getitem__)
+            for prefix, positions in buckets.items()
+        }
+
+    def top(self, prefix: str, limit: int) -> list:
+        """
+        Find the keys with the highest counts that start with a prefix.
+
+        Args:
+            prefix (str): Lower-case prefix.
+            limit (int): Most keys to return.
+        Returns:
+            (list): (key, count) pairs, highest count first.
+        """
+        if len(prefix) <= RANKED_PREFIX_LENGTH and limit <= RANKED_COUNT:
+            positions = self.ranked.get(prefix, [])[:limit]
+        else:
+            first = bisect_left(self.keys, prefix)
+            last = bisect_left(self.keys, prefix + HIGHEST, first)
+            positions = heapq.nlargest(limit, range(first, last), key=self.counts.__getitem__)
+        return [(self.keys[position], self.counts[position]) for position in positions]
+
+
+class SuggestIndex(object):
+    """
+    Suggestions for one generation of the search index.
+    """
+
+    def __init__(self, generation: int):
+        """
+        Instance initializer.
+
+        Args:
+            generation (int): Index generation the suggestions come from.
+        """
+        self.generation = generation
+        self.words = None
+        self.names = {}
+        self.all_names = None
+        self._word_counts = {}
+        self._name_counts = {}
+        self._display = {}
+
+    def add_section_name(self, code: str, section_name: str):
+        """
+        Add the name of one section.
+
+        Args:
+            code (str): Lower-case code abbreviation.
+            section_name (str): Section name as stored in the index.
+        """
+        if not section_name:
+            return
+        key = section_name.lower().strip()
+        self._display.setdefault(key, section_name.strip())
+        counts = self._name_counts.setdefault(code, {})
+        counts[key] = counts.get(key, 0) + 1
+
+    def add_words(self, lexicon):
+        """
+        Add the vocabulary of an indexed field.
+
+        Args:
+            lexicon (iterable): (word, document frequency) pairs.
+        """
+        counts = self._word_counts
+        for word, frequency in lexicon:
+            counts[word] = max(counts.get(word, 0), frequency)
+
+    def finish(self):
+        """
+        Build the prefix lists. Call this once everything has been added.
+        """
+        all_names = {}
+        for code, counts in self._name_counts.items():
+            self.names[code] = PrefixList(counts)
+            for key, count in counts.items():
+                all_names[key] = all_names.get(key, 0) + count
+        self.all_names = PrefixList(all_names)
+        self.words = PrefixList(self._word_counts)
+        self._word_counts = {}
+        self._name_counts = {}
+
+    def suggest_words(self, prefix: str, limit: int) -> list:
+        """
+        Complete the last word of a prefix.
+
+        Args:
+            prefix (str): Lower-case text typed so far.
+            limit (int): Most suggestions to return.
+        Returns:
+            (list): Completed prefixes, most frequent words first.
+        """
+        head, _, stem = prefix.rpartition(' ')
+        if not stem:
+            return []
+        head = f'{head} ' if head else ''
+        return [head + word for word, count in self.words.top(stem, limit)]
+
+    def suggest_names(self, prefix: str, codes: tuple, limit: int) -> list:
+        """
+        Find section names that start with a prefix.
+
+        Args:
+            prefix (str): Lower-case text typed so far.
+            codes (tuple): Codes to look in. Empty for all.
+            limit (int): Most suggestions to return.
+        Returns:
+            (list): Section names, the most common first.
+        """
+        if not prefix:
+            return []
+        if not codes:
+            best = self.all_names.top(prefix, limit)
+        else:
+            matches = {}
+            for code in codes:
+                names = self.names.get(code.lower())
+                if names is None:
+                    continue
+                for key, count in names.top(prefix, limit):
+                    matches[key] = matches.get(key, 0) + count
+            best = heapq.nlargest(limit, matches.items(), key=lambda item: item[1])
+        return [self._display[key] for key, count in best]
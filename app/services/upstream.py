@@ -0,0 +1,198 @@
+"""
+upstream.py - Shared HTTP clients for the services we call (FRED, Zillow,
+PublicData).
+
+Each upstream gets one requests.Session for the life of the process, so
+connections are kept alive and reused from a pool instead of paying for a
+new TCP and TLS handshake on every call. Every request has connect and read
+timeouts, idempotent requests are retried with exponential backoff on
+connection errors, timeouts, and 429/5xx responses, and a semaphore caps how
+many requests to one upstream are in flight at once. Callers wait up to
+QUEUE_TIMEOUT seconds for a free slot.
+
+fan_out() calls several upstreams at once on a pool of threads shared by
+every request in the process, so a lookup that needs more than one source
+waits for the slowest of them instead of all of them in turn. It works under
+any WSGI server; the per-upstream semaphores still cap what is in flight.
+
+Settings are read from the environment, first as <UPSTREAM>_<SETTING> and
+then as UPSTREAM_<SETTING>, e.g. FRED_READ_TIMEOUT or UPSTREAM_READ_TIMEOUT.
+Each upstream's base URL can be set with <UPSTREAM>_BASE_URL, which is how
+the services are pointed at a local stub server for testing.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import util.util as UTIL
+
+# Settings used when neither <UPSTREAM>_<SETTING> nor UPSTREAM_<SETTING> is set.
+DEFAULTS = {
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 15,
+    'RETRIES': 3,
+    'BACKOFF': 0.5,
+    'POOL_SIZE': 10,
+    'MAX_CONCURRENT': 10,
+    'QUEUE_TIMEOUT': 10,
+}
+
+# Threads shared by every request for calling upstreams at the same time.
+FAN_OUT_WORKERS = int(UTIL.get_env('UPSTREAM_FAN_OUT_WORKERS', 32))
+
+# Responses worth retrying after a pause.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Base URL of each upstream unless <UPSTREAM>_BASE_URL says otherwise.
+BASE_URLS = {
+    'FRED': 'https://api.stlouisfed.org/fred',
+    'ZILLOW': 'https://www.zillow.com/webservice',
+    'PUBLIC_DATA': 'http://lbsearch.publicdata.com',
+    'PUBLIC_DATA_LOGIN': 'https://login.publicdata.com',
+}
+
+
+class UpstreamBusy(requests.exceptions.RequestException):
+    """
+    Raised when an upstream already has as many requests in flight as it is
+    allowed and none finished in time.
+    """
+
+
+class Upstream(object):
+    """
+    Pooled, rate-limited HTTP client for one upstream service.
+    """
+
+    def __init__(self, name: str):
+        """
+        Instance initializer.
+
+        Args:
+            name (str): Upstream name, e.g. FRED. Also the prefix of its settings.
+        """
+        self.name = name
+        self.base_url = UTIL.get_env(f'{name}_BASE_URL', BASE_URLS.get(name, '')).rstrip('/')
+        self.timeout = (float(setting(name, 'CONNECT_TIMEOUT')), float(setting(name, 'READ_TIMEOUT')))
+        self.max_concurrent = int(setting(name, 'MAX_CONCURRENT'))
+        self.queue_timeout = float(setting(name, 'QUEUE_TIMEOUT'))
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+
+        retries = int(setting(name, 'RETRIES'))
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=float(setting(name, 'BACKOFF')),
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        )
+        pool_size = int(setting(name, 'POOL_SIZE'))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path: str) -> str:
+        """
+        Build a URL from a path under the upstream's base URL.
+
+        Args:
+            path (str): Path and query string, e.g. /series/observations?series_id=X
+        Returns:
+            (str): Full URL.
+        """
+        return f'{self.base_url}/{path.lstrip("/")}'
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        Send a GET request, waiting for a free slot if the upstream is busy.
+
+        Args:
+            url (str): Full URL, e.g. from url().
+            **kwargs: Passed to requests.Session.get(). The timeout defaults
+                      to the upstream's connect and read timeouts.
+        Returns:
+            (requests.Response): Response, whatever its status.
+        Raises:
+            UpstreamBusy: If no slot frees up within the queue timeout.
+            requests.exceptions.RequestException: If the request fails after retries.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise UpstreamBusy(f"{self.name} has {self.max_concurrent} requests in flight")
+        try:
+            return self.session.get(url, **kwargs)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """
+        Close the pooled connections.
+        """
+        self.session.close()
+
+
+def setting(name: str, key: str):
+    """
+    Get an upstream setting from <name>_<key>, UPSTREAM_<key>, or DEFAULTS.
+    """
+    return UTIL.get_env(f'{name}_{key}', UTIL.get_env(f'UPSTREAM_{key}', DEFAULTS[key]))
+
+
+UPSTREAMS = {}
+UPSTREAMS_LOCK = threading.Lock()
+FAN_OUT_POOL = None
+
+
+def upstream(name: str) -> Upstream:
+    """
+    Get the process-wide client for an upstream, creating it on first use.
+
+    Args:
+        name (str): Upstream name, e.g. FRED, ZILLOW, PUBLIC_DATA.
+    Returns:
+        (Upstream): The client.
+    """
+    client = UPSTREAMS.get(name)
+    if client is None:
+        with UPSTREAMS_LOCK:
+            client = UPSTREAMS.get(name)
+            if client is None:
+                client = Upstream(name)
+                UPSTREAMS[name] = client
+    return client
+
+
+def fan_out(calls: dict) -> dict:
+    """
+    Run several upstream calls at the same time on the shared pool and wait
+    for all of them.
+
+    Args:
+        calls (dict): Functions taking no arguments, keyed by name.
+    Returns:
+        (dict): Each function's result keyed by its name, or None for a
+        function that raised. Errors are logged.
+    """
+    global FAN_OUT_POOL
+    if FAN_OUT_POOL is None:
+        with UPSTREAMS_LOCK:
+            if FAN_OUT_POOL is None:
+                FAN_OUT_POOL = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix='upstream')
+    futures = {name: FAN_OUT_POOL.submit(call) for name, call in calls.items()}
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            UTIL.logmessage(f"Error calling {name}: {str(e)}")
+            results[name] = None
+    return results
@@ -7,13 +7,16 @@ Copyright (c) 2020 by Thomas J. Daley, J.D. Licensed under BSD License.
 """
 from datetime import datetime
 import os
-import requests
 import xml.etree.ElementTree as ET
 import xml
 
+from services.single_flight import SingleFlight
+from services.upstream import upstream
 import util.util as UTIL
 
-SEARCH_URL = "https://www.zillow.com/webservice/GetSearchResults.htm?zws-id={}&address={}&citystatezip={}"
+ZILLOW = upstream('ZILLOW')
+FLIGHTS = SingleFlight('ZILLOW')
+SEARCH_URL = ZILLOW.url("GetSearchResults.htm?zws-id={}&address={}&citystatezip={}")
 SOURCE = "ZILLOW"
 
 
@@ -50,11 +53,10 @@ class Zillow(object):
                                  The *object* is an ET tree, if successful otherwise NoneType.
         """
         try:
-            # Retrieve response from server
-            response = requests.get(url, allow_redirects=False)
-
-            # Convert response from stream of bytes to string
-            content = response.content.decode()
+            # Retrieve response from server, sharing the call with any
+            # identical request made at the same time, and convert it from
+            # a stream of bytes to a string
+            content = FLIGHTS.do(url, lambda: ZILLOW.get(url, allow_redirects=False).content.decode())
 
             # Deserialize response to XML element tree
             tree = ET.ElementTree(ET.fromstring(content))
@@ -0,0 +1,120 @@
+"""
+cache.py - In-process LRU cache bounded by size in bytes and by age.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from collections import OrderedDict
+import json
+import threading
+import time
+
+
+class LruCache(object):
+    """
+    Least-recently-used cache whose entries expire after *ttl* seconds and
+    whose total size never exceeds *max_bytes*. Values must be JSON-serializable
+    because their size is measured by serializing them.
+
+    Cached values are shared between callers, so callers must not modify them.
+    """
+
+    def __init__(self, max_bytes: int, ttl: int):
+        """
+        Instance initializer.
+
+        Args:
+            max_bytes (int): Largest total size of the cached values.
+            ttl (int): Seconds a value may stay in the cache. Zero means forever.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a value from the cache.
+
+        Args:
+            key: Hashable cache key.
+        Returns:
+            The cached value or None if not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires = entry
+            if expires and expires < time.time():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value) -> bool:
+        """
+        Add a value to the cache, evicting the least recently used
+        values to make room for it.
+
+        Args:
+            key: Hashable cache key.
+            value: JSON-serializable value to cache.
+        Returns:
+            (bool): True if the value was cached, False if it is too big to cache.
+        """
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return False
+        expires = time.time() + self.ttl if self.ttl else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and self.bytes + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (value, size, expires)
+            self.bytes += size
+        return True
+
+    def clear(self, *args):
+        """
+        Remove everything from the cache. Accepts and ignores any arguments so
+        it can be used directly as a callback.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Get cache statistics.
+
+        Returns:
+            (dict): Entry count, size, and hit/miss counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        """
+        Remove an entry. Caller must hold the lock.
+        """
+        value, size, expires = self._entries.pop(key)
+        self.bytes -= size
@@ -0,0 +1,185 @@
+"""
+doc_store.py - Append-only store for the large bodies of indexed sections.
+
+The full text and source text of each section are kept out of the Whoosh
+index. They are appended to DATA_FILE in the index directory, and
+INDEX_FILE records where each body starts and how long its parts are.
+Documents in the search index refer to their body by its body_id, which
+is its position in INDEX_FILE and never changes, even when Whoosh merges
+segments and renumbers documents.
+
+Readers memory-map both files, so reading a body decodes it straight from
+the page cache without reading the whole file or unpickling anything.
+
+Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from array import array
+import mmap
+import os
+
+DATA_FILE = 'docstore.dat'
+INDEX_FILE = 'docstore.idx'
+
+# Each body has three unsigned 64-bit entries in INDEX_FILE: offset of the
+# body in DATA_FILE, length of the text, and length of the source text.
+ENTRY_TYPE = 'Q'
+ENTRIES = 3
+RECORD_SIZE = array(ENTRY_TYPE).itemsize * ENTRIES
+
+
+def exists_in(index_path: str) -> bool:
+    """
+    See if an index directory has a document store.
+
+    Args:
+        index_path (str): Index directory.
+    Returns:
+        (bool): True if there is a document store.
+    """
+    return os.path.exists(os.path.join(index_path, INDEX_FILE))
+
+
+class DocStore(object):
+    """
+    Read-only view of a document store.
+    """
+
+    def __init__(self, index_path: str):
+        """
+        Instance initializer.
+
+        Args:
+            index_path (str): Index directory holding the store.
+        """
+        self._maps = []
+        self._views = []
+        self._data = self._map(os.path.join(index_path, DATA_FILE))
+        index = self._map(os.path.join(index_path, INDEX_FILE))
+        usable = len(index) - len(index) % RECORD_SIZE
+        self._index = self._view(index[:usable].cast(ENTRY_TYPE))
+        self.count = len(self._index) // ENTRIES
+
+    def _map(self, file_name: str) -> memoryview:
+        with open(file_name, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return self._view(memoryview(b''))
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return self._view(memoryview(mapped))
+
+    def _view(self, view: memoryview) -> memoryview:
+        self._views.append(view)
+        return view
+
+    def get(self, body_id: int) -> (str, str):
+        """
+        Read one body.
+
+        Args:
+            body_id (int): Body ID stored with the document in the index.
+        Returns:
+            (str, str): Text and source text.
+        Raises:
+            KeyError: If there is no such body.
+        """
+        if body_id is None or not 0 <= body_id < self.count:
+            raise KeyError(body_id)
+        entry = body_id * ENTRIES
+        offset = self._index[entry]
+        text_length = self._index[entry + 1]
+        source_length = self._index[entry + 2]
+        middle = offset + text_length
+        text = str(self._data[offset:middle], 'utf-8')
+        source_text = str(self._data[middle:middle + source_length], 'utf-8')
+        return (text, source_text)
+
+    def close(self):
+        """
+        Unmap the store. Bodies already read remain valid.
+        """
+        # Views must be released before the maps under them can be closed.
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+
+class DocStoreWriter(object):
+    """
+    Appends bodies to a document store. Only one writer may be open on a
+    store at a time; readers can keep reading while it writes, and see the
+    new bodies once they reopen the store.
+    """
+
+    def __init__(self, index_path: str, truncate: bool = False):
+        """
+        Instance initializer.
+
+        Args:
+            index_path (str): Index directory holding the store.
+            truncate (bool): Start an empty store, discarding any bodies in it.
+        """
+        mode = 'wb' if truncate else 'ab'
+        self._data = open(os.path.join(index_path, DATA_FILE), mode)
+        self._index = open(os.path.join(index_path, INDEX_FILE), mode)
+
+        # Drop a partial record left by a writer that did not finish.
+        index_size = self._index.tell()
+        if index_size % RECORD_SIZE:
+            index_size -= index_size % RECORD_SIZE
+            self._index.truncate(index_size)
+            self._index.seek(index_size)
+
+        self._offset = self._data.tell()
+        self._next_id = index_size // RECORD_SIZE
+        self._entries = array(ENTRY_TYPE)
+
+    def add(self, text: str, source_text: str) -> int:
+        """
+        Append one body.
+
+        Args:
+            text (str): Text of the section.
+            source_text (str): Source text of the section.
+        Returns:
+            (int): Body ID to store with the document.
+        """
+        text_bytes = (text or '').encode('utf-8')
+        source_bytes = (source_text or '').encode('utf-8')
+        self._data.write(text_bytes)
+        self._data.write(source_bytes)
+        self._entries.extend((self._offset, len(text_bytes), len(source_bytes)))
+        self._offset += len(text_bytes) + len(source_bytes)
+        body_id = self._next_id
+        self._next_id += 1
+        return body_id
+
+    def flush(self):
+        """
+        Write the locations of the bodies added so far and flush both files
+        to disk. Call this before committing documents that refer to the
+        bodies. The data is synced before the locations are written, so a
+        location never points past the end of the data.
+        """
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._entries.tofile(self._index)
+        self._entries = array(ENTRY_TYPE)
+        self._index.flush()
+        os.fsync(self._index.fileno())
+
+    def close(self):
+        """
+        Flush and close the store.
+        """
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -3,12 +3,14 @@ functions.py - Various utility functions.
 
 Copyright (c) 2020 by Thomas J. Daley, J.D.
 """
+from datetime import datetime
 import glob
 import json
 import os
+import shutil
 
 from whoosh.index import exists_in, open_dir
-from whoosh.fields import DATETIME, Schema, TEXT
+from whoosh.fields import DATETIME, NUMERIC, Schema, TEXT
 
 import util.util as UTIL
 
@@ -16,20 +18,37 @@ import util.util as UTIL
 INDEX_PATH = UTIL.get_env('INDEX_PATH', 'index')
 CODE_PATH = UTIL.get_env('CODE_PATH', 'index')
 
+# When True, each code is indexed into its own index (shard) instead of 'main'.
+SHARDED = UTIL.get_env_bool('INDEX_SHARDED', False)
+MAIN_INDEX = 'main'
+
+# Versions of the index live in INDEX_PATH/versions/<version>. The CURRENT
+# file names the version being served. Without a CURRENT file, the index
+# lives directly in INDEX_PATH.
+VERSIONS_PATH = os.path.join(INDEX_PATH, 'versions')
+CURRENT_FILE = os.path.join(INDEX_PATH, 'CURRENT')
+
 
 def schema():
+    """
+    Schema of the code search index. The text and source text of each
+    section are indexed but not stored; they live in the document store
+    (util.doc_store) under the document's body_id. Code, title, and chapter
+    are sortable, so hit counts can be grouped by them from columns.
+    """
     return Schema(
-        code=TEXT(stored=True),
+        code=TEXT(stored=True, sortable=True),
         code_name=TEXT(stored=True),
-        title=TEXT(stored=True),
+        title=TEXT(stored=True, sortable=True),
         subtitle=TEXT(stored=True),
-        chapter=TEXT(stored=True),
+        chapter=TEXT(stored=True, sortable=True),
         subchapter=TEXT(stored=True),
         section_prefix=TEXT(stored=True),
         section_number=TEXT(stored=True),
         section_name=TEXT(stored=True),
-        text=TEXT(stored=True),
-        source_text=TEXT(stored=True),
+        text=TEXT,
+        source_text=TEXT,
+        body_id=NUMERIC(stored=True),
         filename=TEXT(stored=True),
         future_effective_date=DATETIME(stored=True)
     )
@@ -58,7 +77,7 @@ def enumerate_indices() -> list:
     Returns:
         (list): List of code abbreviations that have been indexed
     """
-    files = glob.glob(f'{INDEX_PATH}/_??_*.toc')
+    files = glob.glob(f'{current_index_path()}/_??_*.toc')
     indices = []
     for toc in files:
         begin_position = toc.find('_', 0) + 1
@@ -74,22 +93,43 @@ def index_name(args) -> str:
     """
     This is *THE* way we create index names.
     I tried an experiment with putting each codified book into its own
-    index, thus the commented code below.
-
-    But I could not merge the search results properly, so now I'm back
-    to indexing everying into one common index called 'main'.
+    index, but I could not merge the search results properly, so
+    everything went into one common index called 'main'.
     /tjd/ 2020-04-06
 
+    Per-code indexes are back as an option (INDEX_SHARDED=Y). The search
+    service now searches the shards through one searcher that shares term
+    statistics across them, so scores merge the same way they would in
+    a single index.
+
     Args:
         args (argpase): Argparse arguments. (somtimes passed as a str)
 
     Returns:
         (str): Index name we use for this code section
     """
-    return 'main'
-    # if isinstance(args, str):
-    #     return args.lower().strip()
-    # return args.code.lower().strip()
+    if not SHARDED or args is None:
+        return MAIN_INDEX
+    if isinstance(args, str):
+        return args.lower().strip()
+    return args.code.lower().strip()
+
+
+def index_names(index_path: str) -> list:
+    """
+    List the indexes in an index directory.
+
+    Args:
+        index_path (str): Index directory.
+    Returns:
+        (list): Index names, sorted. Per-code shard names if SHARDED, else ['main'].
+    """
+    if not SHARDED:
+        return [MAIN_INDEX]
+    names = set()
+    for toc in glob.glob(os.path.join(index_path, '_??_*.toc')):
+        names.add(os.path.basename(toc)[1:3])
+    return sorted(names)
 
 
 def index_exists(args) -> bool:
@@ -101,9 +141,10 @@ def index_exists(args) -> bool:
     Returns:
         (bool): True if the index exists, otherwise False.
     """
-    if not os.path.exists(INDEX_PATH):
+    index_path = current_index_path()
+    if not os.path.exists(index_path):
         return False
-    return exists_in(INDEX_PATH, index_name(args))
+    return exists_in(index_path, index_name(args))
 
 
 def open_index(args):
@@ -115,5 +156,94 @@ def open_index(args):
     Returns:
         (whoosh.index): Instance of index
     """
-    index = open_dir(INDEX_PATH, index_name(args))
+    index = open_dir(current_index_path(), index_name(args))
     return index
+
+
+def current_index_path() -> str:
+    """
+    Find the directory holding the version of the index we should serve.
+
+    Args:
+        None
+    Returns:
+        (str): Index directory.
+    """
+    try:
+        with open(CURRENT_FILE, 'r') as fp:
+            version = fp.read().strip()
+    except FileNotFoundError:
+        return INDEX_PATH
+    return os.path.join(VERSIONS_PATH, version)
+
+
+def new_index_version() -> (str, str):
+    """
+    Create an empty directory for a new version of the index.
+
+    Args:
+        None
+    Returns:
+        (str, str): Version name and the directory created for it.
+    """
+    version = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    path = os.path.join(VERSIONS_PATH, version)
+    os.makedirs(path)
+    return (version, path)
+
+
+def copy_index_version(source_path: str) -> (str, str):
+    """
+    Create a new version of the index that starts as a copy of another, so
+    it can be changed without touching the version being served.
+
+    Args:
+        source_path (str): Index directory to copy, e.g. current_index_path().
+    Returns:
+        (str, str): Version name and the directory created for it.
+    """
+    version, path = new_index_version()
+    try:
+        # An index in INDEX_PATH itself sits beside the versions directory.
+        ignore = shutil.ignore_patterns('versions', 'CURRENT*', 'downloads.json', '*_WRITELOCK')
+        shutil.copytree(source_path, path, ignore=ignore, dirs_exist_ok=True)
+    except Exception:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    return (version, path)
+
+
+def publish_index_version(version: str):
+    """
+    Atomically point CURRENT at a new version of the index.
+
+    Args:
+        version (str): Version name from new_index_version().
+    Returns:
+        None
+    """
+    temp_file = f'{CURRENT_FILE}.{os.getpid()}'
+    with open(temp_file, 'w') as fp:
+        fp.write(version)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temp_file, CURRENT_FILE)
+
+
+def prune_index_versions(keep: int):
+    """
+    Delete all but the newest versions of the index. The current version is
+    never deleted.
+
+    Args:
+        keep (int): Number of versions to keep.
+    Returns:
+        None
+    """
+    if not os.path.exists(VERSIONS_PATH):
+        return
+    current = os.path.basename(current_index_path())
+    versions = sorted(os.listdir(VERSIONS_PATH), reverse=True)
+    for version in versions[keep:]:
+        if version != current:
+            shutil.rmtree(os.path.join(VERSIONS_PATH, version), ignore_errors=True)
@@ -4,7 +4,9 @@ util.py - Utility functions
 Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 """
 import os
+import time
 import dotenv
+import redis
 
 # Load environment variables
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
@@ -12,6 +14,13 @@ dotenv.load_dotenv(dotenv_path)
 
 VERSION = "0.0.1"
 
+# Requests an access key can make per second.
+RATE_LIMIT = int(os.environ.get('RATE_LIMIT', 3))
+
+# Queries an access key can run per second in batch searches, on top of the
+# request itself.
+BATCH_RATE_LIMIT = int(os.environ.get('BATCH_RATE_LIMIT', 100))
+
 
 def failure_message(message: str, code: str) -> dict:
     """
@@ -85,6 +94,59 @@ def logmessage(message: str):
     print(message)
 
 
+def redis_connection():
+    """
+    Return a connection to our Redis service.
+    """
+    return redis.Redis(
+        host=get_env('REDIS_HOST', 'localhost'),
+        port=int(get_env('REDIS_PORT', 6379)),
+        db=0
+    )
+
+
+def rate_limited(redis_client, token: str) -> bool:
+    """
+    Count a request against an access key's rate limit for the current second.
+
+    Args:
+        redis_client (redis.Redis): Connection holding the counters.
+        token (str): Access key making the request.
+    Returns:
+        (bool): True if the key is over its limit and the request should be rejected.
+    """
+    key = f'rate_{token}_{int(time.time())}'
+    pipe = redis_client.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, 1)
+    result = pipe.execute()
+    return result[0] >= RATE_LIMIT
+
+
+def batch_rate_limited(redis_client, token: str, queries: int) -> bool:
+    """
+    Charge the queries of a batch search against an access key's batch
+    budget for the current second. A batch the budget cannot cover is not
+    charged, so it does not use up the budget of the batches after it.
+
+    Args:
+        redis_client (redis.Redis): Connection holding the counters.
+        token (str): Access key making the request.
+        queries (int): Number of queries in the batch.
+    Returns:
+        (bool): True if the batch should be rejected.
+    """
+    key = f'batch_{token}_{int(time.time())}'
+    pipe = redis_client.pipeline()
+    pipe.incrby(key, queries)
+    pipe.expire(key, 1)
+    result = pipe.execute()
+    if result[0] > BATCH_RATE_LIMIT:
+        redis_client.decrby(key, queries)
+        return True
+    return False
+
+
 def success_message() -> dict:
     """
     Return a dict that is a standard failure message.